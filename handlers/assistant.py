@@ -1,27 +1,47 @@
 # handlers/assistant.py
+import asyncio
 import html
 import logging
 import os
 import re
+from typing import Optional
 import aiohttp
 from aiogram import Router, F, types
 from aiogram.filters import Command, StateFilter
 from aiogram.enums import ChatAction
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
 from aiogram.fsm.context import FSMContext
 from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from states.product_states import ProductSelection
 import services.data_store as store
-from services.assistant_service import get_assistant_reply, trim_history
+from services import callback_codec
+from services.assistant_service import (
+    ERROR_REPLIES, StreamInterrupted, get_assistant_reply, stream_assistant_reply, trim_history,
+)
+from services.chat_coalescer import ChatCoalescer
+from services.http_client import get_session
+from services.response_cache import FIRST_TURN_CACHE, first_turn_cache, is_first_turn, normalize_question
 from services.messages import MSG
 from keyboards import get_main_menu
 # Импортируем finalize из каталога, чтобы кнопка ИИ вела сразу в карточку товара
-from handlers.catalog import finalize 
+from handlers.catalog import STALE_ITEM, finalize
 
 router = Router()
 logger = logging.getLogger(__name__)
 
+STREAMING = os.getenv("AI_STREAMING", "1") != "0"
+STREAM_EDIT_INTERVAL = float(os.getenv("AI_STREAM_EDIT_INTERVAL", "1.2"))  # секунд между правками — лимиты Telegram
+STREAM_CURSOR = " ▌"
+COALESCE_WINDOW = float(os.getenv("AI_COALESCE_WINDOW", "1.0"))  # секунд тишины, после которых серия сообщений уходит в AI
+
+QUEUE_NEXT     = "⏳ Вы следующий — Андрей.ai заканчивает с предыдущим вопросом..."
+QUEUE_POSITION = "⏳ Сейчас много вопросов — вы {position}-й в очереди. Ответ скоро будет!"
+INTERRUPTED    = "\n\n⚠️ <i>Ответ прервался на полуслове — спросите ещё раз, пожалуйста.</i>"
+
+coalescer = ChatCoalescer(COALESCE_WINDOW)
+
 def extract_recommendations(reply: str, kb: InlineKeyboardBuilder):
     """Ищет тег [RECOMMEND: id1, id2], удаляет его из текста и добавляет инлайн-кнопки."""
     match = re.search(r'\[RECOMMEND:\s*(.+?)\]', reply)
@@ -35,20 +55,128 @@ def extract_recommendations(reply: str, kb: InlineKeyboardBuilder):
         
         for item_id in item_ids:
             # Ищем товар по ID
-            item = next((x for x in store.CATALOG if str(x.get("id")) == item_id), None)
+            item = store.INDEX.get(item_id)
             if item:
                 # Генерируем красивое название для кнопки
                 btn_text = f"👉 Смотреть: {item.get('title')} {item.get('memory', '')}".replace(" -", "").strip()
                 
-                # Безопасно обрезаем строку, пока она не станет легче 60 байт.
-                cb_data = f"rec_{item_id}"
-                while len(cb_data.encode('utf-8')) > 60:
-                    cb_data = cb_data[:-1]
-                    
-                kb.row(InlineKeyboardButton(text=btn_text, callback_data=cb_data))
+                kb.row(InlineKeyboardButton(text=btn_text, callback_data=callback_codec.encode("rec_", item)))
                 
     return reply, kb
 
+def _visible_part(text: str) -> str:
+    """Текст для промежуточной правки: без тега [RECOMMEND], в том числе недописанного."""
+    cut = text.find("[RECOMMEND")
+    if cut == -1:
+        tail = text.rfind("[")
+        if tail != -1 and "[RECOMMEND".startswith(text[tail:]):
+            cut = tail
+    return (text[:cut] if cut != -1 else text).strip()
+
+async def _stream_reply(message: types.Message, user_text: str, history: list, on_queued=None):
+    """
+    Читает ответ потоком и показывает его по мере генерации в одном сообщении.
+    Правки не чаще STREAM_EDIT_INTERVAL и без HTML — недописанный текст может
+    содержать незакрытые теги. Возвращает ответ, отправленное сообщение и признак
+    обрыва потока (тогда ответ неполный).
+    """
+    loop = asyncio.get_running_loop()
+    parts, sent, shown = [], None, ""
+    next_edit = 0.0
+
+    try:
+        async for chunk in stream_assistant_reply(user_message=user_text, history=history, catalog=store.CATALOG, on_queued=on_queued):
+            parts.append(chunk)
+            now = loop.time()
+            if now < next_edit:
+                continue
+            visible = _visible_part("".join(parts))
+            if not visible or visible == shown:
+                continue
+            next_edit = now + STREAM_EDIT_INTERVAL
+            try:
+                if sent is None: sent = await message.answer(visible + STREAM_CURSOR, parse_mode=None)
+                else: await sent.edit_text(visible + STREAM_CURSOR, parse_mode=None)
+                shown = visible
+            except TelegramRetryAfter as e:
+                next_edit = now + e.retry_after
+            except TelegramAPIError as e:
+                logger.warning(f"Stream edit error: {e}")
+    except StreamInterrupted as e:
+        logger.warning(f"AI stream interrupted: {e}")
+        return "".join(parts), sent, True
+    except asyncio.CancelledError:
+        # Ответ устарел (пришло новое сообщение / «Назад») — убираем недописанный текст
+        if sent is not None:
+            try: await sent.delete()
+            except TelegramAPIError: pass
+        raise
+
+    return "".join(parts), sent, False
+
+async def _respond(message: types.Message, user_text: str, history: list, use_cache: bool = True) -> Optional[str]:
+    """
+    Отвечает пользователю от AI-Genius (потоком, если включено) и возвращает сырой ответ.
+    Первый вопрос диалога сначала ищем в кеше (use_cache=False — спросить модель заново;
+    весь кеш выключается AI_FIRST_TURN_CACHE=0).
+    None — ответ оборвался: клиент видит пометку, в историю и кеш такой ответ не попадает.
+    """
+    cacheable = use_cache and FIRST_TURN_CACHE and is_first_turn(history)
+    generation = store.GENERATION
+    if cacheable:
+        cached = first_turn_cache.get(user_text, generation)
+        if cached is not None:
+            coalescer.settle(message.chat.id)
+            await _send_final(message, cached, None)
+            return cached
+
+    await message.bot.send_chat_action(message.chat.id, ChatAction.TYPING)
+    status = []   # сообщение «вы в очереди», если пришлось ждать
+    interrupted = False
+
+    async def on_queued(position: int):
+        text = QUEUE_NEXT if position == 1 else QUEUE_POSITION.format(position=position)
+        if not status: status.append(await message.answer(text))
+        else: await status[0].edit_text(text)
+
+    try:
+        if STREAMING:
+            reply, sent, interrupted = await _stream_reply(message, user_text, history, on_queued)
+        else:
+            reply, sent = await get_assistant_reply(user_message=user_text, history=history, catalog=store.CATALOG, on_queued=on_queued), None
+        # Ответ получен — дальше только доставка и запись в историю, новое сообщение их не отменит
+        coalescer.settle(message.chat.id)
+    finally:
+        if status:
+            try: await status[0].delete()
+            except TelegramAPIError: pass
+
+    if interrupted:
+        await _send_final(message, _visible_part(reply) + INTERRUPTED, sent)
+        return None
+
+    if cacheable and reply and reply not in ERROR_REPLIES:
+        first_turn_cache.put(user_text, generation, reply)
+    await _send_final(message, reply, sent)
+    return reply
+
+async def _send_final(message: types.Message, reply: str, sent):
+    """Итоговый ответ с HTML и кнопками: новым сообщением или правкой потокового."""
+    kb = InlineKeyboardBuilder()
+    text, kb = extract_recommendations(reply, kb)
+    kb.row(InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="ai_pause"))
+
+    if sent is None:
+        await message.answer(text, reply_markup=kb.as_markup())
+        return
+    try:
+        await sent.edit_text(text, reply_markup=kb.as_markup())
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e): return
+        # Модель прислала невалидный HTML — показываем как есть, но с кнопками
+        logger.warning(f"Final stream edit error: {e}")
+        await sent.edit_text(text, reply_markup=kb.as_markup(), parse_mode=None)
+
 async def _launch_assistant(target, state: FSMContext):
     data = await state.get_data()
     history = data.get("chat_history", [])
@@ -79,6 +207,7 @@ async def start_assistant(callback: types.CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "ai_pause")
 async def ai_pause(callback: types.CallbackQuery, state: FSMContext):
     """Скрытая магия: перекидываем в меню, но сохраняем историю диалога в памяти!"""
+    coalescer.cancel(callback.message.chat.id)   # недописанный ответ больше не нужен
     await state.set_state(None) 
     await callback.message.answer(
         "🍏 <b>Главное меню</b>\n\n"
@@ -90,14 +219,13 @@ async def ai_pause(callback: types.CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data.startswith("rec_"))
 async def handle_recommendation_click(callback: types.CallbackQuery, state: FSMContext):
-    item_id_prefix = callback.data.replace("rec_", "")
-    item = next((x for x in store.CATALOG if str(x.get("id")).startswith(item_id_prefix)), None)
+    item, stale = callback_codec.decode(callback.data.replace("rec_", "", 1))
     
     if item:
         await callback.answer("Загружаю карточку товара...")
         await finalize(callback, item, state)
     else:
-        await callback.answer("❌ Товар не найден или уже продан", show_alert=True)
+        await callback.answer(STALE_ITEM if stale else "❌ Товар не найден или уже продан", show_alert=True)
 
 # ФИКС: Ограничиваем режим консультации только личными сообщениями
 @router.message(F.chat.type == "private", StateFilter(ProductSelection.consulting), F.text)
@@ -105,21 +233,21 @@ async def assistant_message(message: types.Message, state: FSMContext):
     user_text = (message.text or "").strip()
     if not user_text: return
 
+    await message.bot.send_chat_action(message.chat.id, ChatAction.TYPING)
+    coalescer.submit(message.chat.id, user_text, lambda text: _consult(message, state, text))
+
+async def _consult(message: types.Message, state: FSMContext, user_text: str):
+    """Один ход консультации: запрос к AI по (склеенному) тексту и запись в историю."""
     data = await state.get_data()
     history = data.get("chat_history", [])
 
-    await message.bot.send_chat_action(message.chat.id, ChatAction.TYPING)
-    reply = await get_assistant_reply(user_message=user_text, history=history, catalog=store.CATALOG)
+    reply = await _respond(message, user_text, history)
+    if reply is None:
+        return   # оборванный ответ не запоминаем — следующий ход начнётся с той же истории
 
     history.extend([{"role": "user", "content": user_text}, {"role": "assistant", "content": reply}])
     await state.update_data(chat_history=trim_history(history))
 
-    kb = InlineKeyboardBuilder()
-    reply, kb = extract_recommendations(reply, kb)
-    kb.row(InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="ai_pause"))
-    
-    await message.answer(reply, reply_markup=kb.as_markup())
-
 # ФИКС: Ограничиваем голосовые сообщения только личными сообщениями
 @router.message(F.chat.type == "private", F.voice)
 async def handle_voice(message: types.Message, state: FSMContext):
@@ -132,18 +260,17 @@ async def handle_voice(message: types.Message, state: FSMContext):
     file_bytes = await message.bot.download_file(voice_file.file_path)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            data = aiohttp.FormData()
-            data.add_field("file", file_bytes, filename="voice.ogg", content_type="audio/ogg")
-            data.add_field("model", "whisper-1")
-            data.add_field("language", "ru")
-            async with session.post(
-                "https://api.openai.com/v1/audio/transcriptions",
-                headers={"Authorization": f"Bearer {openai_key}"},
-                data=data, timeout=aiohttp.ClientTimeout(total=30)
-            ) as resp:
-                result = await resp.json()
-                user_text = result.get("text", "").strip()
+        data = aiohttp.FormData()
+        data.add_field("file", file_bytes, filename="voice.ogg", content_type="audio/ogg")
+        data.add_field("model", "whisper-1")
+        data.add_field("language", "ru")
+        async with get_session().post(
+            "https://api.openai.com/v1/audio/transcriptions",
+            headers={"Authorization": f"Bearer {openai_key}"},
+            data=data, timeout=aiohttp.ClientTimeout(total=30)
+        ) as resp:
+            result = await resp.json()
+            user_text = result.get("text", "").strip()
     except Exception as e:
         logger.error(f"Whisper error: {e}")
         return await message.answer(MSG["voice_failed"])
@@ -156,16 +283,7 @@ async def handle_voice(message: types.Message, state: FSMContext):
         await state.set_state(ProductSelection.consulting)
         await state.update_data(chat_history=[{"role": "assistant", "content": MSG["assistant_greeting"]}])
 
-    data = await state.get_data()
-    history = data.get("chat_history", [])
-    reply = await get_assistant_reply(user_message=user_text, history=history, catalog=store.CATALOG)
-    history.extend([{"role": "user", "content": user_text}, {"role": "assistant", "content": reply}])
-    await state.update_data(chat_history=trim_history(history))
-
-    kb = InlineKeyboardBuilder()
-    reply, kb = extract_recommendations(reply, kb)
-    kb.row(InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="ai_pause"))
-    await message.answer(reply, reply_markup=kb.as_markup())
+    coalescer.submit(message.chat.id, user_text, lambda text: _consult(message, state, text))
 
 # ФИКС: Ограничиваем свободный ввод текста только личными сообщениями
 @router.message(F.chat.type == "private", ~StateFilter(ProductSelection.selecting), ~StateFilter(ProductSelection.waiting_for_magic_photo), ~StateFilter(ProductSelection.consulting), F.text)
@@ -174,12 +292,16 @@ async def handle_free_text(message: types.Message, state: FSMContext):
     if text.startswith("🤖") or text.startswith("🏠") or text.startswith("🔄") or text.startswith("✨"): return
 
     await _launch_assistant(message, state)
-    await message.bot.send_chat_action(message.chat.id, ChatAction.TYPING)
-    reply = await get_assistant_reply(user_message=text, history=[], catalog=store.CATALOG)
-    
-    await state.update_data(chat_history=[{"role": "user", "content": text}, {"role": "assistant", "content": reply}])
-    
-    kb = InlineKeyboardBuilder()
-    reply, kb = extract_recommendations(reply, kb)
-    kb.row(InlineKeyboardButton(text="⬅️ Назад в меню", callback_data="ai_pause"))
-    await message.answer(reply, reply_markup=kb.as_markup())
+    coalescer.submit(message.chat.id, text, lambda merged: _first_turn(message, state, merged))
+
+async def _first_turn(message: types.Message, state: FSMContext, text: str):
+    # Клиент вернулся и задал тот же вопрос — готовый ответ его не устроил, спрашиваем модель заново
+    data = await state.get_data()
+    repeated = normalize_question(data.get("last_opener", "")) == normalize_question(text)
+    reply = await _respond(message, text, [], use_cache=not repeated)
+    if reply is None:
+        return
+    await state.update_data(
+        chat_history=[{"role": "user", "content": text}, {"role": "assistant", "content": reply}],
+        last_opener=text,
+    )
@@ -10,8 +10,9 @@ from aiogram.types import InlineKeyboardButton
 from aiogram.exceptions import TelegramBadRequest
 
 from states.product_states import ProductSelection
-from services.sheets_manager import get_data_from_sheet, get_settings
+from services.catalog_refresher import refresher
 import services.data_store as store
+from services import callback_codec
 from services.messages import MSG, BTN
 from keyboards import get_main_menu, get_dynamic_keyboard
 from utils.media import get_stub, send_photo_safe
@@ -19,21 +20,11 @@ from utils.media import get_stub, send_photo_safe
 router = Router()
 logger = logging.getLogger(__name__)
 MANAGER_ID = os.getenv('MANAGER_ID')
-
-# ─── СЛОВАРЬ НОВИНОК (ДЛЯ СВОРАЧИВАНИЯ СПИСКОВ) ───
-NOVELTY_KEYWORDS = {
-    "iphone": ["17", "16"],
-    "ipad": ["m4", "m2", "pro", "air 6"],
-    "mac": ["m3", "m4"],
-    "watch": ["series 10", "ultra 2", "se"],
-    "airpods": ["4", "pro 2", "max"],
-    "dyson": ["airwrap", "airstrait", "gen5", "v15", "supersonic"],
-    "xiaomi": ["14", "13", "pad 6"]
-}
+STALE_ITEM = "⏳ Кнопка устарела — каталог обновился. Откройте подбор заново."
 
 async def load_all():
-    store.CATALOG = get_data_from_sheet()
-    store.SETTINGS = get_settings()
+    # Каталогом владеет фоновый refresher — здесь только принудительное обновление
+    await refresher.refresh(force=True)
 
 @router.message(Command("reset"))
 async def cmd_reset(message: types.Message, state: FSMContext):
@@ -63,105 +54,47 @@ async def back_to_main(callback: types.CallbackQuery, state: FSMContext):
 @router.callback_query(F.data.startswith("cat_"))
 async def start_category(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("Загрузка...")
-    await load_all()
     cat = callback.data.split("_")[1]
     await state.set_state(ProductSelection.selecting)
     await run_step(callback, state, {"cat": cat}, 0)
 
 async def run_step(callback, state, filters, idx):
-    data = [i for i in store.CATALOG if filters["cat"].lower() in str(i.get("model_group", i.get("Модель", ""))).lower()]
-    
-    for i in range(idx):
-        stage = store.STAGES[i]
-        if stage in filters and filters[stage] != "*SKIPPED*":
-            req_val = filters[stage]
-            data = [
-                d for d in data 
-                if str(d.get(stage, "")).strip() == req_val 
-                or (req_val == "-" and not str(d.get(stage, "")).strip())
-            ]
-
-    if not data:
+    # Спуск по скомпилированному дереву воронки: выбранные этапы → текущий узел
+    node = store.INDEX.funnel(filters["cat"])
+    for stage in store.STAGES[:idx]:
+        if node is None: break
+        node = node.children.get(filters.get(stage))
+
+    # Этапы, где выбирать нечего, проходим сразу (пропуск категории, «-», единственное значение)
+    while node is not None and node.auto is not None:
+        filters[node.stage] = node.auto
+        node = node.children[node.auto]
+        idx += 1
+
+    if node is None:
         return await callback.message.answer(MSG["out_of_stock"], reply_markup=get_main_menu())
 
-    if idx >= len(store.STAGES):
-        return await finalize(callback, data[0], state)
-
-    step_name = store.STAGES[idx]
-    cat = filters.get("cat", "").lower()
-    
-    SKIP_BY_CAT = {
-        "iphone":  {"size", "memory_ram"},
-        "airpods": {"size", "sim", "memory_ram"},
-        "watch":   {"size", "sim", "memory_ram", "memory"},
-        "dyson":   {"size", "sim", "memory_ram", "memory"},
-    }
-    
-    if step_name in SKIP_BY_CAT.get(cat, set()):
-        filters[step_name] = "*SKIPPED*"
-        return await run_step(callback, state, filters, idx + 1)
-
-    vals_raw = [str(d.get(step_name, "")).strip() for d in data]
-    vals_raw = ["-" if not v else v for v in vals_raw]
-    vals = sorted(list(set(vals_raw)))
-
-    if len(vals) == 1 and vals[0] == "-":
-        filters[step_name] = "-"
-        return await run_step(callback, state, filters, idx + 1)
-        
-    if step_name == "region" and len(vals) <= 1:
-        filters[step_name] = vals[0] if vals else "-"
-        return await run_step(callback, state, filters, idx + 1)
+    if node.stage is None:
+        return await finalize(callback, node.first, state)
 
-    real_vals = [v for v in vals if v != "-"]
-    if step_name != "model_group" and len(real_vals) == 1:
-        filters[step_name] = real_vals[0]
-        return await run_step(callback, state, filters, idx + 1)
+    step_name = node.stage
+    real_vals = node.options
 
     # ─── ЛОГИКА СВОРАЧИВАНИЯ СПИСКОВ ───
     extra_btn = None
-    if step_name == "model_group" and len(real_vals) > 5:
-        show_all = filters.get("show_all_models", False)
-        keywords = NOVELTY_KEYWORDS.get(cat, [])
-        
-        if keywords:
-            novelties = [v for v in real_vals if any(kw in str(v).lower() for kw in keywords)]
-            older = [v for v in real_vals if v not in novelties]
-            
-            if novelties and older:
-                if not show_all:
-                    real_vals = novelties
-                    extra_btn = {"text": "🔻 Другие модели", "callback_data": "toggle_models"}
-                else:
-                    extra_btn = {"text": "🔺 Свернуть", "callback_data": "toggle_models"}
+    if node.novelties:
+        if not filters.get("show_all_models", False):
+            real_vals = node.novelties
+            extra_btn = {"text": "🔻 Другие модели", "callback_data": "toggle_models"}
+        else:
+            extra_btn = {"text": "🔺 Свернуть", "callback_data": "toggle_models"}
 
     val_map = {}
     kb_list = []
     for i, v in enumerate(real_vals):
         key = str(i)
         val_map[key] = v
-
-        if step_name == "sim":
-            sim_labels = {"eSim": "eSIM + eSIM", "Dual eSim": "eSIM + eSIM", "Nano+eSim": "Физическая SIM + eSIM", "Nano+nano": "Физическая SIM + Физическая SIM"}
-            kb_list.append((key, sim_labels.get(v, v)))
-            continue
-
-        if step_name == "memory":
-            prices = []
-            for row in data:
-                m = str(row.get("memory", "")).strip()
-                if not m: m = "-"
-                if m == v:
-                    try:
-                        p_str = str(row.get("price", "0")).replace(" ", "").replace(",", "")
-                        p = int(float(p_str))
-                        if p > 0: prices.append(p)
-                    except ValueError: pass
-            label = f"{v}  —  от {min(prices):,} ₽".replace(",", " ") if prices else v
-        else:
-            label = v
-
-        kb_list.append((key, label))
+        kb_list.append((key, node.labels[v]))
 
     await state.update_data(filters=filters, idx=idx, val_map=val_map)
 
@@ -216,42 +149,18 @@ async def handle_selection(callback: types.CallbackQuery, state: FSMContext):
     filters[store.STAGES[s["idx"]]] = val
     await run_step(callback, state, filters, s["idx"] + 1)
 
-# ─── БЛОК: Бесшовный выбор цвета ───
-def get_siblings(item):
-    siblings = []
-    for d in store.CATALOG:
-        if d.get("availability", "").lower() != "in stock": continue
-        if (d.get("model_group") == item.get("model_group") and
-            d.get("memory") == item.get("memory") and
-            d.get("memory_ram") == item.get("memory_ram") and
-            d.get("sim") == item.get("sim") and
-            d.get("size") == item.get("size")):
-            siblings.append(d)
-    return siblings
-
+# ─── БЛОК: Бесшовный выбор цвета (варианты берём из индекса поколения) ───
 @router.callback_query(F.data.startswith("csw_"))
 async def show_color_options(callback: types.CallbackQuery, state: FSMContext):
-    item_id_prefix = callback.data.replace("csw_", "")
-    item = next((x for x in store.CATALOG if str(x.get("id")).startswith(item_id_prefix)), None)
-    if not item: return await callback.answer("❌ Товар не найден", show_alert=True)
+    item, stale = callback_codec.decode(callback.data.replace("csw_", "", 1))
+    if not item: return await callback.answer(STALE_ITEM if stale else "❌ Товар не найден", show_alert=True)
     
-    siblings = get_siblings(item)
-    unique_colors = {}
-    for sib in siblings:
-        c = sib.get("color", "-")
-        if c != "-" and c not in unique_colors:
-            unique_colors[c] = sib
-            
     kb = InlineKeyboardBuilder()
-    for c, sib in unique_colors.items():
+    for c, sib in store.INDEX.variants(item).colors.items():
         prefix = "✅ " if c == item.get("color") else ""
-        cb_data = f"csel_{sib['id']}"
-        while len(cb_data.encode('utf-8')) > 60: cb_data = cb_data[:-1]
-        kb.row(InlineKeyboardButton(text=f"{prefix}{c}", callback_data=cb_data))
+        kb.row(InlineKeyboardButton(text=f"{prefix}{c}", callback_data=callback_codec.encode("csel_", sib)))
         
-    back_data = f"csel_{item['id']}"
-    while len(back_data.encode('utf-8')) > 60: back_data = back_data[:-1]
-    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=back_data))
+    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=callback_codec.encode("csel_", item)))
     
     try: await callback.message.edit_reply_markup(reply_markup=kb.as_markup())
     except TelegramBadRequest: pass
@@ -259,9 +168,8 @@ async def show_color_options(callback: types.CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data.startswith("csel_"))
 async def select_new_color(callback: types.CallbackQuery, state: FSMContext):
-    item_id_prefix = callback.data.replace("csel_", "")
-    item = next((x for x in store.CATALOG if str(x.get("id")).startswith(item_id_prefix)), None)
-    if not item: return await callback.answer("❌ Товар не найден", show_alert=True)
+    item, stale = callback_codec.decode(callback.data.replace("csel_", "", 1))
+    if not item: return await callback.answer(STALE_ITEM if stale else "❌ Товар не найден", show_alert=True)
     await callback.answer("Загружаю...")
     await finalize(callback, item, state)
 
@@ -283,16 +191,13 @@ async def finalize(callback, item, state):
             + f"🌍 Регион: {reg}\n\n💰 <b>Цена: {p} ₽</b>\n\n"
             + MSG["product_card_footer"])
 
-    siblings = get_siblings(item)
-    colors_available = list(set([s.get("color", "-") for s in siblings if s.get("color", "-") != "-"]))
+    colors_available = store.INDEX.variants(item).colors
 
     kb = InlineKeyboardBuilder()
     
     # 1. 🎨 Другой цвет
     if len(colors_available) > 1:
-        cb_data = f"csw_{item['id']}"
-        while len(cb_data.encode('utf-8')) > 60: cb_data = cb_data[:-1]
-        kb.row(InlineKeyboardButton(text=BTN["other_color"], callback_data=cb_data))
+        kb.row(InlineKeyboardButton(text=BTN["other_color"], callback_data=callback_codec.encode("csw_", item)))
         
     kb.row(InlineKeyboardButton(text=BTN["confirm_order"], callback_data="confirm_order"))
     kb.row(InlineKeyboardButton(text=BTN["magic"], callback_data="magic_tryon"))
@@ -12,7 +12,7 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardButton
 
 from states.product_states import ProductSelection
-from services.kie_service import KieService
+from services.kie_service import KieService, pick_photo_size
 from services.messages import MSG, BTN, MAGIC_MESSAGES
 from keyboards import get_main_menu
 
@@ -58,8 +58,9 @@ async def magic_process(message: types.Message, state: FSMContext):
     animator = asyncio.create_task(_animate_magic_msg(msg, stop_event))
 
     try:
-        # 1. Скачиваем только фото пользователя
-        file = await message.bot.get_file(message.photo[-1].file_id)
+        # 1. Скачиваем только фото пользователя — в размере, близком к 1K, в котором работает модель
+        photo = pick_photo_size(message.photo)
+        file = await message.bot.get_file(photo.file_id)
         user_photo_bytes = (await message.bot.download_file(file.file_path)).read()
         await message.bot.send_chat_action(message.chat.id, ChatAction.UPLOAD_PHOTO)
 
@@ -1,7 +1,12 @@
 # main.py
 import asyncio
+import hashlib
 import logging
+import multiprocessing
 import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
 from dotenv import load_dotenv
 
 # 1. СНАЧАЛА загружаем .env — до любых импортов которые читают os.getenv()
@@ -12,11 +17,34 @@ load_dotenv()
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.exceptions import TelegramAPIError
 from aiogram.types import BotCommand, BotCommandScopeDefault, MenuButtonCommands
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
 # 3. И только теперь наши роутеры
 from handlers import catalog, assistant, magic, group, channel
-from handlers.catalog import load_all
+from services.catalog_refresher import refresher
+from services.sheets_manager import sheets
+from services.http_client import open_sessions, close_sessions
+from services.file_id_cache import file_ids
+from services.fsm_storage import build_storage
+from services.image_pipeline import shutdown_pool
+from services.kie_poller import KIE_CALLBACK_URL
+from utils.concurrency import ConcurrencyMiddleware
+from utils.media import enable_prefetch
+
+# ── Режим получения апдейтов ─────────────────────────────────────────────────
+BOT_MODE         = os.getenv("BOT_MODE", "polling")            # polling | webhook
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")           # https://bot.example.com — публичный адрес
+WEBHOOK_PATH     = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET   = os.getenv("WEBHOOK_SECRET", "")             # X-Telegram-Bot-Api-Secret-Token
+WEBAPP_HOST      = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT      = int(os.getenv("WEBAPP_PORT", "8080"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # параллельных доставок от Telegram
+UPDATE_CONCURRENCY      = int(os.getenv("UPDATE_CONCURRENCY", "64"))       # апдейтов в обработке одновременно
+BOT_WORKERS      = int(os.getenv("BOT_WORKERS", "0"))          # 0 — всё в одном процессе; N — N процессов-воркеров
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "1000"))  # апдейтов в очереди одного воркера
 
 
 async def set_bot_commands(bot: Bot):
@@ -29,16 +57,73 @@ async def set_bot_commands(bot: Bot):
     await bot.set_chat_menu_button(menu_button=MenuButtonCommands())
 
 
-async def main():
-    logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger(__name__)
-    logger.info("vnxChooseApple Bot Started (Modular Architecture)")
+def webhook_secret(token: str) -> str:
+    """Секрет вебхука: из .env или стабильный (от токена) — одинаковый у всех инстансов за балансировщиком."""
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    return hashlib.sha256(f"vnx-webhook:{token}".encode()).hexdigest()[:48]
+
+
+async def run_polling(bot: Bot, dp: Dispatcher):
+    # getUpdates не работает, пока у бота висит вебхук от webhook-режима
+    await bot.delete_webhook(drop_pending_updates=False)
+
+    # Колбэки KIE (магия) — отдельным маленьким сервером, если задан KIE_CALLBACK_URL
+    runner = None
+    if KIE_CALLBACK_URL:
+        app = web.Application()
+        magic.kie_ai.poller.enable_callbacks(app)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if runner:
+            await runner.cleanup()
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """
+    Встроенный aiohttp-сервер принимает апдейты от Telegram. Запросы без верного
+    секретного заголовка отклоняются; ответ Telegram уходит сразу, апдейт
+    обрабатывается в фоне (не больше UPDATE_CONCURRENCY одновременно).
+    """
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_BASE_URL")
+    secret = webhook_secret(bot.token)
+
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=WEBHOOK_PATH)
+    magic.kie_ai.poller.enable_callbacks(app)   # результаты магии — по колбэку KIE, если задан KIE_CALLBACK_URL
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    await bot.set_webhook(
+        f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    logging.getLogger(__name__).info(f"Webhook: слушаем {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()   # до остановки процесса
+    finally:
+        await runner.cleanup()
+
 
-    bot = Bot(
+def make_bot() -> Bot:
+    return Bot(
         token=os.getenv("BOT_TOKEN"),
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
-    dp = Dispatcher()
+
+
+def build_dispatcher() -> Dispatcher:
+    # FSM (история AI-диалога, фильтры воронки) хранится вне процесса — переживает перезапуск
+    dp = Dispatcher(storage=build_storage())
 
     # ── Порядок роутеров КРИТИЧЕН ────────────────────────────────────────────
     # 1. group     — фильтры для группы (Chat ID проверяется первым)
@@ -53,10 +138,202 @@ async def main():
     dp.include_router(magic.router)
     dp.include_router(assistant.router)   # catch-all — только последним!
     # ────────────────────────────────────────────────────────────────────────
+    dp.update.outer_middleware(ConcurrencyMiddleware(UPDATE_CONCURRENCY))
+    return dp
+
+
+# ── Шардирование по чатам (BOT_WORKERS > 0) ──────────────────────────────────
+# Ведущий процесс только принимает апдейты (polling или webhook), обновляет каталог
+# и раскладывает апдейты по воркерам: chat_id % N. Апдейты одного чата всегда
+# попадают в один воркер и в том порядке, в каком пришли. Воркер обрабатывает их
+# обычным Dispatcher с теми же роутерами, а каталог берёт из снимка на диске.
+def chat_key(raw: dict) -> int:
+    """chat_id (или id пользователя) из сырого апдейта Telegram — ключ шарда."""
+    for value in raw.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return int(chat["id"])
+        sender = value.get("from") or value.get("user")
+        if sender and "id" in sender:
+            return int(sender["id"])
+    return 0
+
+
+class ShardPool:
+    def __init__(self, workers: int):
+        ctx = multiprocessing.get_context("spawn")
+        self.queues = [ctx.Queue(SHARD_QUEUE_SIZE) for _ in range(workers)]
+        # По одному потоку на очередь: put'ы одного шарда идут строго в порядке вызовов route
+        self.putters = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"shard-put-{i}") for i in range(workers)]
+        self.processes = [
+            ctx.Process(target=worker_process, args=(i, q), name=f"bot-worker-{i}")
+            for i, q in enumerate(self.queues)
+        ]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        logging.getLogger(__name__).info(f"Shards: запущено воркеров — {len(self.processes)}")
+
+    async def route(self, raw: dict):
+        shard = chat_key(raw) % len(self.queues)
+        # put блокирует, только если воркер не успевает — тогда и приём притормаживает
+        await asyncio.get_running_loop().run_in_executor(self.putters[shard], self.queues[shard].put, raw)
+
+    def stop(self):
+        for putter in self.putters:
+            putter.shutdown(wait=True)
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+
+async def run_sharded_polling(bot: Bot, dp: Dispatcher, pool: ShardPool):
+    logger = logging.getLogger(__name__)
+    await bot.delete_webhook(drop_pending_updates=False)
+    allowed = dp.resolve_used_update_types()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed)
+        except TelegramAPIError as e:
+            logger.warning(f"Shards: getUpdates error: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            # by_alias: ключи как у Telegram ("from", а не "from_user") — их ждут chat_key и воркер
+            await pool.route(update.model_dump(mode="json", exclude_none=True, by_alias=True))
+            offset = update.update_id + 1
+
+
+async def run_sharded_webhook(bot: Bot, dp: Dispatcher, pool: ShardPool):
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_BASE_URL")
+    secret = webhook_secret(bot.token)
+
+    async def handle(request: web.Request) -> web.Response:
+        if not secrets.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), secret):
+            return web.Response(status=401)
+        await pool.route(await request.json())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    await bot.set_webhook(
+        f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def worker_process(index: int, queue):
+    """Точка входа процесса-воркера (spawn: модуль импортируется заново)."""
+    logging.basicConfig(level=logging.INFO, format=f"[w{index}] %(levelname)s:%(name)s:%(message)s")
+    try:
+        asyncio.run(worker_main(queue))
+    except KeyboardInterrupt:
+        pass
+
+
+async def worker_main(queue):
+    bot = make_bot()
+    dp = build_dispatcher()
+    await open_sessions()
+    await file_ids.load()
+    # Каталог — только из снимка ведущего процесса; в Sheets воркер ходит лишь по /reset
+    if not refresher.restore_snapshot():
+        await refresher.refresh()
+    refresher.start(follow=True)
+
+    loop = asyncio.get_running_loop()
+    # Разные чаты — параллельно, апдейты одного чата — строго по очереди (цепочка задач),
+    # иначе два быстрых нажатия перемешают чтение и запись FSM
+    chains: Dict[int, asyncio.Task] = {}
+
+    async def process(raw: dict, previous: Optional[asyncio.Task]):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        try:
+            await dp.feed_raw_update(bot, raw)
+        except Exception as e:
+            logging.getLogger(__name__).exception(f"Shard worker: update {raw.get('update_id')} failed: {e}")
+
+    def release(key: int, task: asyncio.Task):
+        if chains.get(key) is task:
+            del chains[key]
+
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, queue.get)
+            if raw is None:
+                break
+            key = chat_key(raw)
+            task = asyncio.create_task(process(raw, chains.get(key)))
+            chains[key] = task
+            task.add_done_callback(lambda t, k=key: release(k, t))
+        if chains:
+            await asyncio.wait(list(chains.values()), timeout=30)
+    finally:
+        await refresher.stop()
+        await dp.storage.close()
+        sheets.close()
+        shutdown_pool()
+        await close_sessions()
+        await bot.session.close()
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+    logger.info("vnxChooseApple Bot Started (Modular Architecture)")
+
+    bot = make_bot()
+    dp = build_dispatcher()
 
     await set_bot_commands(bot)
-    await load_all()
-    await dp.start_polling(bot)
+    await open_sessions()   # общий пул keep-alive соединений для OpenRouter, KIE, Whisper и картинок
+    enable_prefetch()       # прогрев кеша картинок — только здесь, воркеры читают его с диска
+    await file_ids.load()   # file_id отправленных картинок — до первой карточки
+    # Тёплый старт: отвечаем из снимка на диске, свежий каталог догружается в фоне
+    if refresher.restore_snapshot():
+        refresher.refresh_in_background()
+    else:
+        await refresher.refresh()
+    refresher.start()   # дальше каталог обновляется в фоне, клики читают только снимок в памяти
+
+    pool = ShardPool(BOT_WORKERS) if BOT_WORKERS > 0 else None
+    try:
+        if pool:
+            pool.start()
+            if BOT_MODE == "webhook":
+                await run_sharded_webhook(bot, dp, pool)
+            else:
+                await run_sharded_polling(bot, dp, pool)
+        elif BOT_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            await run_polling(bot, dp)
+    finally:
+        if pool:
+            await asyncio.to_thread(pool.stop)
+        await refresher.stop()
+        await dp.storage.close()
+        sheets.close()
+        shutdown_pool()
+        await close_sessions()
 
 
 if __name__ == "__main__":
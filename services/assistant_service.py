@@ -1,17 +1,27 @@
 # services/assistant_service.py
+import asyncio
 import json
 import logging
-from typing import List, Dict, Any
+from typing import AsyncIterator, List, Dict, Any, Optional, Tuple
 import os
 import aiohttp
 
+from services.catalog_retrieval import RetrievalIndex, recommended_ids
+from services.conversation_memory import compact_history, is_summary
+from services.http_client import get_session
+from services.llm_admission import AdmissionRejected, OnQueued, admission
+
 logger = logging.getLogger(__name__)
 
 # ── Константы ────────────────────────────────────────────────────────────────
 CLAUDE_MODEL = "anthropic/claude-3-haiku" # ФИКС: Перешли на быструю и экономную модель
 MAX_TOKENS      = 1024
 API_URL         = "https://openrouter.ai/api/v1/chat/completions"
-MAX_HISTORY     = 20   # сообщений (10 пар вопрос/ответ) — чтобы не раздувать контекст
+MAX_HISTORY     = 20   # сообщений (10 пар вопрос/ответ) максимум; главный лимит — бюджет токенов AI_HISTORY_TOKENS
+PROMPT_CACHING  = os.getenv("PROMPT_CACHING", "1") != "0"   # cache_control для статичного префикса промпта
+RETRIEVAL_MIN_ITEMS = int(os.getenv("RETRIEVAL_MIN_ITEMS", "120"))  # до стольких товаров в наличии шлём весь каталог
+RETRIEVAL_TOP_N     = int(os.getenv("RETRIEVAL_TOP_N", "40"))       # иначе — столько самых подходящих
+OVERLOAD_PAUSE      = 5.0  # секунд паузы выдачи, если провайдер ответил 429/529 без Retry-After
 
 # ── Уведомления Админу через @vnxSYSNOTIFY_bot ───────────────────────────────
 async def notify_admin(text: str):
@@ -23,40 +33,14 @@ async def notify_admin(text: str):
         return
     url = f"https://api.telegram.org/bot{token}/sendMessage"
     try:
-        async with aiohttp.ClientSession() as session:
-            await session.post(url, json={"chat_id": admin_id, "text": text, "parse_mode": "HTML"})
+        async with get_session().post(url, json={"chat_id": admin_id, "text": text, "parse_mode": "HTML"}) as resp:
+            await resp.read()
     except Exception as e:
         logger.error(f"Admin notification failed: {e}")
 
 # ── Системный промпт — личность Андрея ───────────────────────────────────────
-def build_system_prompt(catalog: List[Dict[str, Any]]) -> str:
-    """
-    Строим системный промпт с актуальным каталогом.
-    Каталог форматируем компактно: только то что нужно для рекомендации.
-    """
-    # Компактный прайс: только модель, память, sim, цвет, цена (в наличии)
-    available = [
-        item for item in catalog
-        if item.get("availability", "").lower() == "in stock"
-    ]
-
-    catalog_lines = []
-    for item in available:
-        parts = [
-            f"[ID: {item.get('id', '')}]",
-            item.get("title", ""),
-            f"{item.get('memory', '')}",
-            item.get("sim", ""),
-            item.get("color", ""),
-            f"{item.get('price', '')} ₽",
-        ]
-        line = " | ".join(p for p in parts if p and p != "-")
-        if line:
-            catalog_lines.append(f"• {line}")
-
-    catalog_str = "\n".join(catalog_lines) if catalog_lines else "каталог временно недоступен"
-
-    return f"""Ты — Андрей.ai, цифровая субличность Андрея — основателя vnxSHOP, эксперта Apple с многолетним опытом личных консультаций. У Андрея более 3000 постоянных клиентов, которые доверяют ему как лучшему другу в мире техники.
+# Статичная часть промпта: одинакова для всех пользователей и всех поколений каталога
+PERSONA_PROMPT = """Ты — Андрей.ai, цифровая субличность Андрея — основателя vnxSHOP, эксперта Apple с многолетним опытом личных консультаций. У Андрея более 3000 постоянных клиентов, которые доверяют ему как лучшему другу в мире техники.
 
 ═══ ФИЛОСОФИЯ И СТИЛЬ ═══
 Ты работаешь в духе Apple Genius Bar — только лучше, потому что ты знаешь каждого клиента лично.
@@ -110,28 +94,125 @@ def build_system_prompt(catalog: List[Dict[str, Any]]) -> str:
 • Если спрашивают про конкурентов (Samsung, Xiaomi и т.д.) — не ругай, но мягко объясни преимущества экосистемы Apple.
 
 ═══ АКТУАЛЬНЫЙ КАТАЛОГ (только в наличии) ═══
-{catalog_str}
 """
 
-# ── Основная функция ──────────────────────────────────────────────────────────
-async def get_assistant_reply(
-    user_message: str,
-    history: List[Dict[str, str]],
+# Кеш отрисованного каталога: каталог — неизменяемый снимок поколения (см. catalog_refresher),
+# поэтому новый список = новое поколение, и перерисовывать промпт нужно только тогда
+_catalog_block_cache: Tuple[Optional[List[Dict[str, Any]]], str] = (None, "")
+_retrieval_cache: Tuple[Optional[List[Dict[str, Any]]], Optional[RetrievalIndex]] = (None, None)
+
+
+def _render_item_line(item: Dict[str, Any]) -> str:
+    # Компактный прайс: только модель, память, sim, цвет, цена
+    parts = [
+        f"[ID: {item.get('id', '')}]",
+        item.get("title", ""),
+        f"{item.get('memory', '')}",
+        item.get("sim", ""),
+        item.get("color", ""),
+        f"{item.get('price', '')} ₽",
+    ]
+    line = " | ".join(p for p in parts if p and p != "-")
+    return f"• {line}" if line else ""
+
+
+def _retrieval_index(catalog: List[Dict[str, Any]]) -> RetrievalIndex:
+    global _retrieval_cache
+    cached_catalog, index = _retrieval_cache
+    if catalog is not cached_catalog or index is None:
+        index = RetrievalIndex(catalog)
+        _retrieval_cache = (catalog, index)
+    return index
+
+
+def render_catalog_block(catalog: List[Dict[str, Any]]) -> str:
+    """
+    Каталог для промпта — компактно: только то что нужно для рекомендации.
+    Строится один раз на поколение каталога.
+    """
+    global _catalog_block_cache
+    cached_catalog, cached_block = _catalog_block_cache
+    if catalog is cached_catalog:
+        return cached_block
+
+    catalog_lines = [line for line in map(_render_item_line, _retrieval_index(catalog).items) if line]
+    block = "\n".join(catalog_lines) if catalog_lines else "каталог временно недоступен"
+    _catalog_block_cache = (catalog, block)
+    return block
+
+
+def render_relevant_block(
     catalog: List[Dict[str, Any]],
-) -> str:
+    history: List[Dict[str, str]],
+    user_message: str,
+) -> Tuple[str, bool]:
     """
-    Отправляет сообщение пользователя в Claude с историей диалога.
+    Большой каталог в промпт целиком не отправляем: локально ранжируем товары по
+    разговору (семейство, бюджет, память, цвет) и оставляем RETRIEVAL_TOP_N лучших.
+    Товары, которые модель уже рекомендовала в диалоге, остаются всегда.
+    Маленький каталог отдаём целиком — так он кешируется у провайдера.
+    Возвращает блок и признак «весь каталог поколения» (только такой имеет смысл кешировать).
     """
-    system_prompt = build_system_prompt(catalog)
+    index = _retrieval_index(catalog)
+    if len(index.items) <= RETRIEVAL_MIN_ITEMS:
+        return render_catalog_block(catalog), True
 
-    # Обрезаем историю если слишком длинная
-    trimmed_history = history[-MAX_HISTORY:] if len(history) > MAX_HISTORY else history
+    user_text = " ".join(m.get("content", "") for m in history if m.get("role") == "user" or is_summary(m))
+    items = index.rank(f"{user_text} {user_message}", recommended_ids(history), RETRIEVAL_TOP_N)
+    lines = [line for line in map(_render_item_line, items) if line]
+    if not lines:
+        return render_catalog_block(catalog), True
+    return (
+        f"(показаны {len(lines)} наиболее подходящих позиций из {len(index.items)} в наличии; "
+        f"если клиент уточнит запрос — список обновится)\n" + "\n".join(lines)
+    ), False
+
+
+def build_system_message(catalog_block: str, cache_catalog: bool = True) -> Dict[str, Any]:
+    """
+    Системное сообщение для OpenRouter. Личность и каталог — отдельные блоки с
+    cache_control: провайдер кеширует префикс и не пересчитывает его на каждом ходе
+    и для каждого пользователя, пока не сменится поколение каталога.
+    Подборка под разговор (cache_catalog=False) меняется каждый ход — её не помечаем,
+    иначе каждый запрос платит за запись в кеш без единого попадания.
+    """
+    if not PROMPT_CACHING:
+        return {"role": "system", "content": PERSONA_PROMPT + catalog_block + "\n"}
+    catalog_part = {"type": "text", "text": catalog_block + "\n"}
+    if cache_catalog:
+        catalog_part["cache_control"] = {"type": "ephemeral"}
+    return {"role": "system", "content": [
+        {"type": "text", "text": PERSONA_PROMPT, "cache_control": {"type": "ephemeral"}},
+        catalog_part,
+    ]}
+
+# ── Тексты ошибок ────────────────────────────────────────────────────────────
+ERR_UNAVAILABLE = "⚠️ Цифровой Андрей временно недоступен — техническая пауза. Напиши напрямую!"
+ERR_OVERLOADED  = "😅 Слишком много запросов к Андрею.ai — попробуй через минуту!"
+ERR_API         = "⚠️ Что-то пошло не так. Напиши Андрею напрямую — он поможет!"
+ERR_TIMEOUT     = "⏳ Андрей.ai думает слишком долго... Попробуй ещё раз!"
+ERR_TEMPORARY   = "⚠️ Временная ошибка. Попробуй ещё раз или напиши Андрею напрямую."
+ERROR_REPLIES   = frozenset({ERR_UNAVAILABLE, ERR_OVERLOADED, ERR_API, ERR_TIMEOUT, ERR_TEMPORARY})
+
+
+class StreamInterrupted(Exception):
+    """Поток оборвался после первых кусков ответа — уже показанный текст неполный."""
+
+
+def _build_request(
+    user_message: str,
+    history: List[Dict[str, str]],
+    catalog: List[Dict[str, Any]],
+) -> Tuple[Dict[str, Any], Dict[str, str]]:
+    # Держим историю в бюджете токенов: старые ходы — сводкой фактов
+    trimmed_history = trim_history(history)
 
     # Добавляем текущее сообщение
     messages = trimmed_history + [{"role": "user", "content": user_message}]
 
     # OpenRouter использует формат OpenAI: system как первое сообщение с role="system"
-    or_messages = [{"role": "system", "content": system_prompt}] + messages
+    catalog_block, full_catalog = render_relevant_block(catalog, trimmed_history, user_message)
+    or_messages = [build_system_message(catalog_block, cache_catalog=full_catalog)] + messages
 
     payload = {
         "model":      CLAUDE_MODEL,
@@ -146,44 +227,149 @@ async def get_assistant_reply(
         "HTTP-Referer":  "https://t.me/vnxSHOP_AppleFinder_bot",
         "X-Title":       "vnxSHOP AI-Genius",
     }
+    return payload, headers
+
+
+async def _status_error(resp: aiohttp.ClientResponse) -> Optional[str]:
+    """Текст для клиента, если OpenRouter ответил кодом ошибки; None — всё в порядке."""
+    # Проверка: если OpenRouter вернул код оплаты 402 (нет денег)
+    if resp.status == 402:
+        await notify_admin("🚨 <b>Внимание!</b> Закончились средства на балансе <b>OpenRouter</b> (AI-Genius).")
+        return ERR_UNAVAILABLE
+    if resp.status == 401:
+        logger.error("Claude API: неверный ключ")
+        return ERR_UNAVAILABLE
+    if resp.status in (429, 529):
+        # Провайдер перегружен — тормозим весь поток запросов, а не только этот
+        try: retry_after = float(resp.headers.get("Retry-After", OVERLOAD_PAUSE))
+        except ValueError: retry_after = OVERLOAD_PAUSE
+        admission.pause(retry_after)
+        return ERR_OVERLOADED
+    return None
+
+
+async def _payload_error(err_info: Dict[str, Any]) -> str:
+    logger.error(f"Claude API error: {json.dumps(err_info, ensure_ascii=False)}")
+    # Дополнительная проверка: код 402 внутри JSON (OpenRouter часто отдает именно так)
+    if err_info.get("code") == 402:
+        await notify_admin("🚨 <b>Внимание!</b> Закончились средства на балансе <b>OpenRouter</b> (AI-Genius).")
+    return ERR_API
+
+
+# ── Основная функция ──────────────────────────────────────────────────────────
+async def get_assistant_reply(
+    user_message: str,
+    history: List[Dict[str, str]],
+    catalog: List[Dict[str, Any]],
+    on_queued: Optional[OnQueued] = None,
+) -> str:
+    """
+    Отправляет сообщение пользователя в Claude с историей диалога.
+    Запрос проходит через admission: при наплыве ждёт своей очереди,
+    on_queued(место) вызывается, пока ждёт.
+    """
+    payload, headers = _build_request(user_message, history, catalog)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                API_URL,
-                json=payload,
-                headers=headers,
-                timeout=aiohttp.ClientTimeout(total=30),
-            ) as resp:
-                # Проверка: если OpenRouter вернул код оплаты 402 (нет денег)
-                if resp.status == 402:
-                    await notify_admin("🚨 <b>Внимание!</b> Закончились средства на балансе <b>OpenRouter</b> (AI-Genius).")
-                    return "⚠️ Цифровой Андрей временно недоступен — техническая пауза. Напиши напрямую!"
-
-                if resp.status == 401:
-                    logger.error("Claude API: неверный ключ")
-                    return "⚠️ Цифровой Андрей временно недоступен — техническая пауза. Напиши напрямую!"
-                if resp.status == 529:
-                    return "😅 Слишком много запросов к Андрею.ai — попробуй через минуту!"
-
-                data = await resp.json()
-
-                if "error" in data:
-                    err_info = data["error"]
-                    logger.error(f"Claude API error: {json.dumps(err_info, ensure_ascii=False)}")
-                    # Дополнительная проверка: код 402 внутри JSON (OpenRouter часто отдает именно так)
-                    if err_info.get("code") == 402:
-                        await notify_admin("🚨 <b>Внимание!</b> Закончились средства на балансе <b>OpenRouter</b> (AI-Genius).")
-                    return "⚠️ Что-то пошло не так. Напиши Андрею напрямую — он поможет!"
-
-                return data["choices"][0]["message"]["content"]
-
-    except aiohttp.ClientTimeout:
-        return "⏳ Андрей.ai думает слишком долго... Попробуй ещё раз!"
+        async with admission.slot(on_queued), get_session().post(
+            API_URL,
+            json=payload,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=30),
+        ) as resp:
+            error = await _status_error(resp)
+            if error:
+                return error
+
+            data = await resp.json()
+
+            if "error" in data:
+                return await _payload_error(data["error"])
+
+            return data["choices"][0]["message"]["content"]
+
+    except AdmissionRejected as e:
+        logger.warning(f"LLM admission: отказ — {e}")
+        return ERR_OVERLOADED
+    except asyncio.TimeoutError:
+        return ERR_TIMEOUT
     except Exception as e:
         logger.error(f"assistant_service error: {e}")
-        return "⚠️ Временная ошибка. Попробуй ещё раз или напиши Андрею напрямую."
+        return ERR_TEMPORARY
+
+
+async def stream_assistant_reply(
+    user_message: str,
+    history: List[Dict[str, str]],
+    catalog: List[Dict[str, Any]],
+    on_queued: Optional[OnQueued] = None,
+) -> AsyncIterator[str]:
+    """
+    То же, что get_assistant_reply, но отдаёт ответ кусками по мере генерации (SSE).
+    Ошибка до первого куска приходит одним куском с текстом для клиента — как у
+    get_assistant_reply; обрыв после него — исключение StreamInterrupted.
+    """
+    payload, headers = _build_request(user_message, history, catalog)
+    payload["stream"] = True
+    got_text = False
+    finished = False
+
+    try:
+        async with admission.slot(on_queued), get_session().post(
+            API_URL,
+            json=payload,
+            headers=headers,
+            # Общий таймаут шире: ответ идёт долго, но без пауз дольше sock_read
+            timeout=aiohttp.ClientTimeout(total=120, sock_read=30),
+        ) as resp:
+            error = await _status_error(resp)
+            if error:
+                yield error
+                return
+
+            async for raw_line in resp.content:
+                line = raw_line.decode("utf-8", errors="ignore").strip()
+                # Пустые строки и комментарии SSE (": OPENROUTER PROCESSING") пропускаем
+                if not line.startswith("data:"):
+                    continue
+                data_str = line[len("data:"):].strip()
+                if data_str == "[DONE]":
+                    finished = True
+                    break
+                try:
+                    chunk = json.loads(data_str)
+                except json.JSONDecodeError:
+                    continue
+                if "error" in chunk:
+                    error = await _payload_error(chunk["error"])
+                    if got_text:
+                        raise StreamInterrupted("provider error mid-stream")
+                    yield error
+                    return
+                choices = chunk.get("choices") or [{}]
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    got_text = True
+                    yield delta
+
+            if got_text and not finished:
+                raise StreamInterrupted("stream closed before [DONE]")
+
+    except StreamInterrupted:
+        raise
+    except AdmissionRejected as e:
+        logger.warning(f"LLM admission: отказ — {e}")
+        yield ERR_OVERLOADED
+    except asyncio.TimeoutError:
+        if got_text:
+            raise StreamInterrupted("timeout mid-stream")
+        yield ERR_TIMEOUT
+    except Exception as e:
+        logger.error(f"assistant_service stream error: {e}")
+        if got_text:
+            raise StreamInterrupted(str(e))
+        yield ERR_TEMPORARY
 
 def trim_history(history: List[Dict[str, str]]) -> List[Dict[str, str]]:
-    """Обрезает историю до MAX_HISTORY последних сообщений."""
-    return history[-MAX_HISTORY:] if len(history) > MAX_HISTORY else history
+    """Сжимает историю под бюджет токенов (не больше MAX_HISTORY сообщений дословно)."""
+    return compact_history(history, max_messages=MAX_HISTORY)
@@ -0,0 +1,94 @@
+# services/callback_codec.py
+import logging
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import services.data_store as store
+from services.catalog_index import CatalogIndex
+from services.catalog_refresher import refresher
+
+logger = logging.getLogger(__name__)
+
+# ── Константы ────────────────────────────────────────────────────────────────
+# Формат: <префикс><поколение>~<позиция строки>~<контрольная сумма ID>, всё в base-62.
+# Пример: "rec_1B~k3~Qz" — 12 байт вместо обрезанного до 60 байт SKU.
+_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_DIGITS = {c: i for i, c in enumerate(_ALPHABET)}
+_SEP = "~"
+_CHECK_MOD = 62 * 62
+KEPT_GENERATIONS = 4   # сколько прошлых поколений помним, чтобы старые кнопки продолжали работать
+
+_history: "OrderedDict[int, CatalogIndex]" = OrderedDict()
+
+
+def _b62(n: int) -> str:
+    if n == 0:
+        return _ALPHABET[0]
+    out = []
+    while n:
+        n, r = divmod(n, 62)
+        out.append(_ALPHABET[r])
+    return "".join(reversed(out))
+
+
+def _from_b62(s: str) -> int:
+    if not s:
+        raise ValueError("empty base62")
+    n = 0
+    for c in s:
+        n = n * 62 + _DIGITS[c]   # KeyError → не наш формат
+    return n
+
+
+def _checksum(item_id: str) -> str:
+    return _b62(zlib.crc32(item_id.encode("utf-8")) % _CHECK_MOD)
+
+
+def _remember_generation():
+    _history[store.GENERATION] = store.INDEX
+    while len(_history) > KEPT_GENERATIONS:
+        _history.popitem(last=False)
+
+
+refresher.add_listener(_remember_generation)
+
+
+def encode(prefix: str, item: Dict[str, Any]) -> str:
+    """Короткий callback_data для товара (обычно текущего поколения)."""
+    item_id = str(item.get("id"))
+    gen, pos = store.GENERATION, store.INDEX.positions.get(item_id)
+    if pos is None:
+        # Поколение сменилось, пока хендлер рендерил карточку — кодируем тем поколением,
+        # где товар был, decode переведёт кнопку на текущий каталог
+        for old_gen, index in reversed(_history.items()):
+            if item_id in index.positions:
+                gen, pos = old_gen, index.positions[item_id]
+                break
+        else:
+            pos = 0   # не найден нигде: контрольная сумма не сойдётся, decode вернёт «устарело»
+    return f"{prefix}{_b62(gen)}{_SEP}{_b62(pos)}{_SEP}{_checksum(item_id)}"
+
+
+def decode(payload: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+    """
+    Товар по callback_data (без префикса) и флаг «кнопка из прошлого поколения».
+    Кнопку прошлого поколения переводим на тот же SKU в текущем каталоге по ID;
+    если поколение уже забыто или контрольная сумма не сходится — товар не угадываем.
+    """
+    try:
+        gen_s, pos_s, check = payload.split(_SEP)
+        gen, pos = _from_b62(gen_s), _from_b62(pos_s)
+    except (ValueError, KeyError):
+        # Кнопки до перехода на кодек содержали сам ID (возможно, обрезанный)
+        return store.INDEX.resolve(payload), False
+
+    index = store.INDEX if gen == store.GENERATION else _history.get(gen)
+    item = index.row(pos) if index is not None else None
+    if item is None or _checksum(str(item.get("id"))) != check:
+        logger.info(f"Устаревшая кнопка товара: {payload!r} (текущее поколение #{store.GENERATION})")
+        return None, True
+
+    if index is store.INDEX:
+        return item, False
+    return store.INDEX.get(str(item.get("id"))), True
@@ -0,0 +1,239 @@
+# services/catalog_index.py
+import logging
+from bisect import bisect_left
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SKIPPED = "*SKIPPED*"
+
+# ─── СЛОВАРЬ НОВИНОК (ДЛЯ СВОРАЧИВАНИЯ СПИСКОВ) ───
+NOVELTY_KEYWORDS = {
+    "iphone": ["17", "16"],
+    "ipad": ["m4", "m2", "pro", "air 6"],
+    "mac": ["m3", "m4"],
+    "watch": ["series 10", "ultra 2", "se"],
+    "airpods": ["4", "pro 2", "max"],
+    "dyson": ["airwrap", "airstrait", "gen5", "v15", "supersonic"],
+    "xiaomi": ["14", "13", "pad 6"]
+}
+
+# ─── Этапы воронки, которые категория пропускает всегда ───
+SKIP_BY_CAT = {
+    "iphone":  {"size", "memory_ram"},
+    "airpods": {"size", "sim", "memory_ram"},
+    "watch":   {"size", "sim", "memory_ram", "memory"},
+    "dyson":   {"size", "sim", "memory_ram", "memory"},
+}
+
+SIM_LABELS = {"eSim": "eSIM + eSIM", "Dual eSim": "eSIM + eSIM", "Nano+eSim": "Физическая SIM + eSIM", "Nano+nano": "Физическая SIM + Физическая SIM"}
+COLLAPSE_MIN_MODELS = 5   # список моделей длиннее — сворачиваем до новинок
+
+# ─── Поля, по которым товары — варианты одной модели (отличаются только цветом) ───
+VARIANT_KEYS = ("model_group", "memory", "memory_ram", "sim", "size")
+
+
+def facet_value(row: Dict[str, Any], stage: str) -> str:
+    """Значение этапа воронки так, как его видит пользователь: пустое → «-»."""
+    return str(row.get(stage, "")).strip() or "-"
+
+
+def _parse_price(row: Dict[str, Any]) -> Optional[int]:
+    try:
+        p = int(float(str(row.get("price", "0")).replace(" ", "").replace(",", "")))
+    except ValueError:
+        return None
+    return p if p > 0 else None
+
+
+class FunnelNode:
+    """
+    Узел дерева воронки: строки категории после выбора этапов [0, depth).
+    stage=None — лист, товар выбран (first — первая строка в порядке каталога).
+    auto — значение, которое воронка подставляет сама (этап пропускается);
+    иначе options/labels/prices — готовые кнопки выбора.
+    """
+    __slots__ = ("stage", "auto", "options", "labels", "prices", "novelties", "children", "first")
+
+    def __init__(self, stage: Optional[str] = None):
+        self.stage = stage
+        self.auto: Optional[str] = None
+        self.options: List[str] = []
+        self.labels: Dict[str, str] = {}
+        self.prices: Dict[str, Tuple[int, int]] = {}   # значение → (min, max) цена
+        self.novelties: Optional[List[str]] = None     # свёрнутый список моделей, если он есть
+        self.children: Dict[str, "FunnelNode"] = {}
+        self.first: Optional[Dict[str, Any]] = None
+
+
+class VariantGroup:
+    """Товары в наличии, отличающиеся только цветом, и цвет → первый такой товар."""
+    __slots__ = ("members", "colors")
+
+    def __init__(self):
+        self.members: List[Dict[str, Any]] = []
+        self.colors: Dict[str, Dict[str, Any]] = {}
+
+
+_NO_VARIANTS = VariantGroup()
+
+
+def _variant_key(row: Dict[str, Any]) -> tuple:
+    return tuple(row.get(k) for k in VARIANT_KEYS)
+
+
+class CatalogIndex:
+    """
+    Фасетный индекс одного поколения каталога.
+    Для каждого этапа воронки: значение → множество позиций строк в каталоге.
+    Из пересечений фасетов компилируется дерево воронки каждой категории,
+    так что шаг воронки — это проход по словарям без агрегации на запрос.
+    Строится один раз при подмене поколения и дальше только читается.
+    """
+
+    def __init__(self, catalog: List[Dict[str, Any]], stages: List[str]):
+        self.catalog = catalog
+        self.stages = stages
+        self._model_groups = [
+            str(row.get("model_group", row.get("Модель", ""))).lower() for row in catalog
+        ]
+        self._categories: Dict[str, FrozenSet[int]] = {}
+        self._funnels: Dict[str, Optional[FunnelNode]] = {}
+        self._prices = [_parse_price(row) for row in catalog]
+
+        # ID → строка (первая в порядке каталога, как давал next(...)) + отсортированные ID для префиксов
+        self.by_id: Dict[str, Dict[str, Any]] = {}
+        self.positions: Dict[str, int] = {}
+        for pos, row in enumerate(catalog):
+            item_id = str(row.get("id"))
+            if item_id not in self.positions:
+                self.positions[item_id] = pos
+                self.by_id[item_id] = row
+        self._sorted_ids = sorted(self.by_id)
+
+        self._variants: Dict[tuple, VariantGroup] = {}
+        for row in catalog:
+            if row.get("availability", "").lower() != "in stock": continue
+            group = self._variants.setdefault(_variant_key(row), VariantGroup())
+            group.members.append(row)
+            c = row.get("color", "-")
+            if c != "-":
+                group.colors.setdefault(c, row)
+
+        facets: Dict[str, Dict[str, set]] = {stage: {} for stage in stages}
+        for pos, row in enumerate(catalog):
+            for stage in stages:
+                facets[stage].setdefault(facet_value(row, stage), set()).add(pos)
+        self.facets: Dict[str, Dict[str, FrozenSet[int]]] = {
+            stage: {val: frozenset(p) for val, p in values.items()}
+            for stage, values in facets.items()
+        }
+
+    def category(self, cat: str) -> FrozenSet[int]:
+        """
+        Строки категории. Категория ищется подстрокой в model_group (mac → MacBook, iMac),
+        поэтому множество считается при первом обращении и кешируется на всё поколение.
+        """
+        key = cat.lower()
+        positions = self._categories.get(key)
+        if positions is None:
+            positions = frozenset(pos for pos, mg in enumerate(self._model_groups) if key in mg)
+            self._categories[key] = positions
+        return positions
+
+    # ── Поиск товара по ID ───────────────────────────────────────────────────
+    def get(self, item_id: str) -> Optional[Dict[str, Any]]:
+        return self.by_id.get(item_id)
+
+    def row(self, pos: int) -> Optional[Dict[str, Any]]:
+        return self.catalog[pos] if 0 <= pos < len(self.catalog) else None
+
+    def resolve(self, prefix: str) -> Optional[Dict[str, Any]]:
+        """
+        Товар по ID или его обрезанному началу (старые callback-кнопки).
+        Точное совпадение важнее префикса; если префиксу соответствуют
+        разные SKU — возвращаем None, а не первый попавшийся.
+        """
+        item = self.by_id.get(prefix)
+        if item is not None or not prefix:
+            return item
+        i = bisect_left(self._sorted_ids, prefix)
+        ids = self._sorted_ids
+        if i >= len(ids) or not ids[i].startswith(prefix):
+            return None
+        if i + 1 < len(ids) and ids[i + 1].startswith(prefix):
+            logger.warning(f"Неоднозначный префикс ID: {prefix!r} ({ids[i]!r}, {ids[i + 1]!r}, ...)")
+            return None
+        return self.by_id[ids[i]]
+
+    def variants(self, item: Dict[str, Any]) -> VariantGroup:
+        """Группа цветовых вариантов товара (только в наличии)."""
+        return self._variants.get(_variant_key(item), _NO_VARIANTS)
+
+    # ── Дерево воронки ───────────────────────────────────────────────────────
+    def funnel(self, cat: str) -> Optional[FunnelNode]:
+        """Корень дерева воронки категории (None — товаров нет). Компилируется один раз."""
+        key = cat.lower()
+        if key not in self._funnels:
+            positions = self.category(key)
+            self._funnels[key] = self._build_node(key, positions, 0) if positions else None
+        return self._funnels[key]
+
+    def warm(self, categories: List[str]):
+        """Компилирует деревья заранее, чтобы первый клик не платил за сборку."""
+        for cat in categories:
+            self.funnel(cat)
+
+    def _build_node(self, cat: str, positions: FrozenSet[int], depth: int) -> FunnelNode:
+        if depth >= len(self.stages):
+            node = FunnelNode()
+            node.first = self.catalog[min(positions)]
+            return node
+
+        stage = self.stages[depth]
+        node = FunnelNode(stage)
+
+        if stage in SKIP_BY_CAT.get(cat, set()):
+            node.auto = SKIPPED
+            node.children[SKIPPED] = self._build_node(cat, positions, depth + 1)
+            return node
+
+        groups = {}
+        for val, facet in self.facets[stage].items():
+            sub = positions & facet
+            if sub:
+                groups[val] = sub
+        vals = sorted(groups)
+        real_vals = [v for v in vals if v != "-"]
+
+        if vals == ["-"]:
+            node.auto = "-"
+        elif stage == "region" and len(vals) <= 1:
+            node.auto = vals[0]
+        elif stage != "model_group" and len(real_vals) == 1:
+            node.auto = real_vals[0]
+        if node.auto is not None:
+            node.children[node.auto] = self._build_node(cat, groups[node.auto], depth + 1)
+            return node
+
+        node.options = real_vals
+        for v in real_vals:
+            node.children[v] = self._build_node(cat, groups[v], depth + 1)
+            prices = [p for p in (self._prices[pos] for pos in groups[v]) if p]
+            if prices:
+                node.prices[v] = (min(prices), max(prices))
+
+            if stage == "sim":
+                node.labels[v] = SIM_LABELS.get(v, v)
+            elif stage == "memory" and v in node.prices:
+                node.labels[v] = f"{v}  —  от {node.prices[v][0]:,} ₽".replace(",", " ")
+            else:
+                node.labels[v] = v
+
+        # ─── ЛОГИКА СВОРАЧИВАНИЯ СПИСКОВ ───
+        keywords = NOVELTY_KEYWORDS.get(cat, [])
+        if stage == "model_group" and len(real_vals) > COLLAPSE_MIN_MODELS and keywords:
+            novelties = [v for v in real_vals if any(kw in str(v).lower() for kw in keywords)]
+            if novelties and len(novelties) < len(real_vals):
+                node.novelties = novelties
+        return node
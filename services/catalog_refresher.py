@@ -0,0 +1,178 @@
+# services/catalog_refresher.py
+import asyncio
+import logging
+import os
+from typing import Callable, List, Optional
+
+import services.data_store as store
+from services.catalog_index import CatalogIndex
+from services.catalog_snapshot import load_snapshot, save_snapshot, snapshot_mtime
+from services.sheets_manager import get_data_from_sheet, get_settings, sheets
+
+logger = logging.getLogger(__name__)
+
+# ── Константы ────────────────────────────────────────────────────────────────
+REFRESH_INTERVAL = int(os.getenv("CATALOG_REFRESH_INTERVAL", "300"))  # секунд между фоновыми обновлениями
+FOLLOW_INTERVAL  = float(os.getenv("CATALOG_FOLLOW_INTERVAL", "5"))   # как часто воркер проверяет снимок на диске
+
+
+def build_index(catalog) -> CatalogIndex:
+    """Индексы поколения (все деревья категорий) — строятся в стороне, до подмены."""
+    index = CatalogIndex(catalog, store.STAGES)
+    index.warm(store.CATEGORIES)
+    return index
+
+
+class CatalogRefresher:
+    """
+    Единственный владелец store.CATALOG / store.SETTINGS.
+    Обновляет каталог в фоне по таймеру, склеивает параллельные запросы на
+    обновление в один (single-flight) и подменяет поколение каталога целиком —
+    хендлеры всегда читают только готовый снимок из памяти.
+    """
+
+    def __init__(self, interval: int = REFRESH_INTERVAL):
+        self.interval = interval
+        self._inflight: Optional[asyncio.Task] = None
+        self._loop_task: Optional[asyncio.Task] = None
+        self._background: Optional[asyncio.Task] = None   # фоновое обновление тёплого старта
+        self._modified: Optional[str] = None   # modifiedTime таблицы на момент последней подмены
+        self._listeners: List[Callable[[], None]] = []
+        self._snapshot_mtime: Optional[float] = None   # какой снимок с диска уже поднят
+
+    def add_listener(self, callback: Callable[[], None]):
+        """Колбэк вызывается после каждой успешной подмены поколения каталога."""
+        self._listeners.append(callback)
+
+    async def refresh(self, force: bool = False) -> bool:
+        """
+        Загружает новое поколение каталога. Если загрузка уже идёт —
+        просто дожидаемся её результата, а не запускаем вторую.
+        Без force неизменившаяся таблица не скачивается и поколение не меняется.
+        Возвращает True, если поколение было подменено.
+        """
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._reload(force))
+        # shield: отмена одного ожидающего не должна обрывать загрузку для остальных
+        return await asyncio.shield(self._inflight)
+
+    def refresh_in_background(self):
+        """Запускает обновление, не дожидаясь его (тёплый старт); ошибка попадёт в лог."""
+        self._background = asyncio.create_task(self.refresh())
+        self._background.add_done_callback(self._log_background)
+
+    @staticmethod
+    def _log_background(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Refresher background refresh error: {task.exception()}")
+
+    async def _reload(self, force: bool) -> bool:
+        incremental = not force and bool(store.CATALOG)
+
+        # 1. Дешёвая проверка по метаданным Drive — без выгрузки листов
+        modified = await sheets.modified_time()
+        if incremental and modified is not None and modified == self._modified:
+            logger.info("Refresher: таблица не менялась, обновление пропущено")
+            return False
+
+        # 2. Таблица менялась (или метаданных нет) — сверяем содержимое
+        catalog, settings = await asyncio.gather(
+            get_data_from_sheet(skip_unchanged=incremental),
+            get_settings(),
+        )
+
+        # Пустой ответ = Sheets недоступен. Старое поколение лучше, чем «нет в наличии».
+        if not settings and store.SETTINGS:
+            settings = store.SETTINGS
+        if catalog is None:
+            catalog = store.CATALOG
+            if settings == store.SETTINGS:
+                self._modified = modified
+                return False
+        elif not catalog and store.CATALOG:
+            logger.warning("Refresher: каталог не загрузился, оставляем предыдущее поколение")
+            return False
+
+        self._modified = modified
+        # Индексы нового поколения строим в потоке — на больших прайсах это сотни мс CPU
+        index = await asyncio.to_thread(build_index, catalog)
+        self._swap(catalog, settings, index)
+        await asyncio.to_thread(save_snapshot, catalog, settings, modified, store.GENERATION)
+        self._snapshot_mtime = snapshot_mtime()   # свой же снимок повторно не подхватываем
+        return True
+
+    def restore_snapshot(self) -> bool:
+        """
+        Поднимает последнее сохранённое поколение с диска — бот отвечает сразу после
+        старта, пока свежая загрузка из Sheets идёт в фоне.
+        """
+        mtime = snapshot_mtime()
+        payload = load_snapshot()
+        if not payload:
+            return False
+        self._snapshot_mtime = mtime
+        self._modified = payload.get("modified")
+        # Продолжаем нумерацию поколений с сохранённой — кнопки до рестарта остаются валидны
+        store.GENERATION = max(store.GENERATION, payload.get("generation", 0) - 1)
+        catalog = payload["catalog"]
+        self._swap(catalog, payload.get("settings") or {}, build_index(catalog))   # до старта — можно синхронно
+        return True
+
+    def _swap(self, catalog, settings, index: CatalogIndex):
+        # Без await между присваиваниями — для event loop подмена атомарна
+        store.CATALOG = catalog
+        store.INDEX = index
+        store.SETTINGS = settings
+        store.GENERATION += 1
+        logger.info(f"Refresher: поколение каталога #{store.GENERATION} ({len(catalog)} строк)")
+
+        for callback in self._listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Refresher listener error: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Refresher error: {e}")
+
+    async def _follow(self):
+        """
+        Режим воркера: Sheets не трогаем, а подхватываем снимок, который пишет
+        ведущий процесс, — все процессы видят одни и те же поколения каталога.
+        """
+        while True:
+            await asyncio.sleep(FOLLOW_INTERVAL)
+            try:
+                mtime = snapshot_mtime()
+                if mtime is not None and mtime != self._snapshot_mtime:
+                    payload = await asyncio.to_thread(load_snapshot)
+                    if payload:
+                        index = await asyncio.to_thread(build_index, payload["catalog"])
+                        self._snapshot_mtime = mtime
+                        self._modified = payload.get("modified")
+                        # Нумерация — как у снимка ведущего: кнопки одного поколения везде значат одно и то же
+                        store.GENERATION = max(store.GENERATION, payload.get("generation", 0) - 1)
+                        self._swap(payload["catalog"], payload.get("settings") or {}, index)
+            except Exception as e:
+                logger.error(f"Refresher follow error: {e}")
+
+    def start(self, follow: bool = False):
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._follow() if follow else self._run())
+
+    async def stop(self):
+        if self._loop_task:
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
+            self._loop_task = None
+
+
+refresher = CatalogRefresher()
@@ -0,0 +1,159 @@
+# services/catalog_retrieval.py
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# ── Константы ────────────────────────────────────────────────────────────────
+BUDGET_MIN, BUDGET_MAX = 5_000, 2_000_000   # всё что вне диапазона — не бюджет (256 GB, iPhone 17...)
+BUDGET_SLACK = 1.15                          # «до 100к» — показываем и то, что чуть дороже
+
+# Как клиенты называют семейства в чате → как они записаны в каталоге
+FAMILY_SYNONYMS = {
+    "iphone":  ["iphone", "айфон", "айфона", "айфоны", "телефон", "смартфон"],
+    "ipad":    ["ipad", "айпад", "планшет"],
+    "macbook": ["macbook", "макбук", "ноутбук", "ноут"],
+    "imac":    ["imac", "аймак", "моноблок"],
+    "mac":     ["mac", "мак"],
+    "watch":   ["watch", "часы", "вотч"],
+    "airpods": ["airpods", "эирподс", "аирподс", "наушники"],
+    "pro":     ["pro", "про"],
+    "max":     ["max", "макс"],
+    "air":     ["air", "эйр"],
+    "mini":    ["mini", "мини"],
+    "ultra":   ["ultra", "ультра"],
+    "se":      ["se"],
+}
+
+COLOR_SYNONYMS = {
+    "black":   ["черн", "чёрн", "black"],
+    "white":   ["бел", "white"],
+    "blue":    ["син", "голуб", "blue"],
+    "pink":    ["розов", "pink"],
+    "green":   ["зелен", "зелён", "green"],
+    "gold":    ["золот", "gold"],
+    "silver":  ["серебр", "silver"],
+    "gray":    ["серый", "серая", "серого", "gray", "grey"],
+    "titanium": ["титан", "titanium"],
+    "purple":  ["фиолет", "purple"],
+    "yellow":  ["желт", "жёлт", "yellow"],
+    "red":     ["красн", "red"],
+    "orange":  ["оранж", "orange"],
+    "natural": ["натурал", "natural"],
+    "desert":  ["пустын", "desert"],
+}
+
+_WORD_RE = re.compile(r"[a-zа-яё0-9]+")
+_MEMORY_RE = re.compile(r"\b(64|128|256|512|1\s?(?:tb|тб)|2\s?(?:tb|тб))(?:\s?(?:gb|гб))?\b")   # 256, 256gb, 256 гб, 1тб
+_BUDGET_RE = re.compile(
+    r"(\d+(?:[.,]\d+)?)\s*(к|k|тыс|т\.?\s?р)"        # 100к, 1.5k, 80 тыс
+    r"|(\d{1,3}(?:[ \u00a0]\d{3})+)\s*(?:₽|р\b|руб)"  # 100 000 ₽
+    r"|(\d{4,7})"                                    # 100000
+)
+_RECOMMEND_RE = re.compile(r"\[RECOMMEND:\s*(.+?)\]")
+
+
+def _parse_price(item: Dict[str, Any]) -> int:
+    try:
+        return int(float(str(item.get("price", "0")).replace(" ", "").replace(",", "")))
+    except ValueError:
+        return 0
+
+
+def _norm_memory(text: str) -> str:
+    return text.lower().replace(" ", "").replace("тб", "tb").replace("gb", "")
+
+
+def extract_budget(text: str) -> Optional[int]:
+    """Последняя упомянутая сумма, похожая на бюджет (в рублях)."""
+    budget = None
+    for m in _BUDGET_RE.finditer(text.lower()):
+        if m.group(1):
+            value = float(m.group(1).replace(",", ".")) * 1000
+        else:
+            value = float(re.sub(r"\D", "", m.group(3) or m.group(4)))
+        if BUDGET_MIN <= value <= BUDGET_MAX:
+            budget = int(value)
+    return budget
+
+
+def recommended_ids(history: Iterable[Dict[str, str]]) -> List[str]:
+    """ID из тегов [RECOMMEND: ...], которые модель уже выдавала в этом диалоге."""
+    ids = []
+    for msg in history:
+        if msg.get("role") != "assistant":
+            continue
+        for m in _RECOMMEND_RE.finditer(str(msg.get("content", ""))):
+            ids.extend(i.strip() for i in m.group(1).split(","))
+    return ids
+
+
+class RetrievalIndex:
+    """
+    Подготовленный к ранжированию каталог одного поколения: только товары в наличии,
+    с предрассчитанными словами, ценой, памятью и цветом.
+    """
+
+    def __init__(self, catalog: List[Dict[str, Any]]):
+        self.items: List[Dict[str, Any]] = []
+        self.words: List[set] = []
+        self.prices: List[int] = []
+        self.memories: List[str] = []
+        self.colors: List[str] = []
+        self.by_id: Dict[str, int] = {}
+        for item in catalog:
+            if item.get("availability", "").lower() != "in stock":
+                continue
+            text = f"{item.get('title', '')} {item.get('model_group', '')}".lower()
+            self.by_id.setdefault(str(item.get("id", "")), len(self.items))
+            self.items.append(item)
+            self.words.append(set(_WORD_RE.findall(text)))
+            self.prices.append(_parse_price(item))
+            self.memories.append(_norm_memory(str(item.get("memory", ""))))
+            self.colors.append(str(item.get("color", "")).lower())
+
+        # Обзор ассортимента для разговора без сигналов: самый дешёвый вариант каждой модели
+        cheapest: Dict[str, int] = {}
+        for i, item in enumerate(self.items):
+            group = str(item.get("model_group", ""))
+            if group not in cheapest or 0 < self.prices[i] < self.prices[cheapest[group]]:
+                cheapest[group] = i
+        self.overview = list(cheapest.values())
+
+    def rank(self, text: str, pinned_ids: Iterable[str], top_n: int) -> List[Dict[str, Any]]:
+        """
+        top_n самых подходящих под разговор товаров (в порядке каталога).
+        Совпадения: семейство/модель, память, цвет; бюджет — бонус за попадание
+        и штраф за заметное превышение. Без сигналов — по одному дешёвому
+        варианту каждой модели, чтобы у консультанта был обзор ассортимента.
+        """
+        text = text.lower()
+        words = set(_WORD_RE.findall(text))
+        families = [f for f, syns in FAMILY_SYNONYMS.items() if any(s in words for s in syns)]
+        numbers = {w for w in words if w.isdigit() and len(w) <= 2}   # «15», «17» — поколения моделей
+        memories = {_norm_memory(m) for m in _MEMORY_RE.findall(text)}
+        colors = [c for c, syns in COLOR_SYNONYMS.items() if any(s in text for s in syns)]
+        budget = extract_budget(text)
+
+        pinned = [self.by_id[i] for i in pinned_ids if i in self.by_id]
+        if not (families or numbers or memories or colors or budget):
+            return [self.items[i] for i in sorted(set(pinned) | set(self.overview[:top_n]))]
+
+        scored: List[Tuple[float, int, int]] = []
+        for i, item_words in enumerate(self.words):
+            score = 3.0 * sum(1 for f in families if f in item_words)
+            score += 2.0 * len(numbers & item_words)
+            if memories and self.memories[i] in memories:
+                score += 2.0
+            if colors and any(c in self.colors[i] for c in colors):
+                score += 1.0
+            price = self.prices[i]
+            if budget and price:
+                if price <= budget:
+                    score += 1.0 + price / budget   # ближе к бюджету — лучше
+                elif price > budget * BUDGET_SLACK:
+                    score -= 3.0
+            if score > 0:
+                scored.append((-score, price, i))
+
+        scored.sort()
+        chosen = set(pinned) | {i for _, _, i in scored[:top_n]}
+        return [self.items[i] for i in sorted(chosen)]
@@ -0,0 +1,73 @@
+# services/catalog_snapshot.py
+import gzip
+import json
+import logging
+import os
+import tempfile
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# ── Константы ────────────────────────────────────────────────────────────────
+SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", "catalog_snapshot.json.gz")
+SNAPSHOT_VERSION = 1
+
+
+def save_snapshot(
+    catalog: List[Dict[str, Any]],
+    settings: Dict[str, str],
+    modified: Optional[str] = None,
+    generation: int = 0,
+):
+    """
+    Сохраняет поколение каталога на диск (gzip + JSON).
+    Пишем во временный файл и подменяем через os.replace — битый снимок
+    при падении посреди записи невозможен. Имя временного файла уникальное:
+    ведущий и воркер (по /reset) могут писать снимок одновременно.
+    """
+    payload = {
+        "version":    SNAPSHOT_VERSION,
+        "generation": generation,
+        "modified":   modified,
+        "catalog":    catalog,
+        "settings":   settings,
+    }
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(SNAPSHOT_PATH)),
+            prefix=f"{os.path.basename(SNAPSHOT_PATH)}.", suffix=".tmp",
+        )
+        with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt", encoding="utf-8", compresslevel=6) as f:
+            json.dump(payload, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, SNAPSHOT_PATH)
+        logger.info(f"Snapshot: сохранено {len(catalog)} строк в {SNAPSHOT_PATH}")
+    except Exception as e:
+        logger.error(f"Snapshot save error: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def snapshot_mtime() -> Optional[float]:
+    """Время записи снимка — по нему воркеры замечают новое поколение."""
+    try:
+        return os.path.getmtime(SNAPSHOT_PATH)
+    except OSError:
+        return None
+
+
+def load_snapshot() -> Optional[Dict[str, Any]]:
+    """Последний сохранённый снимок или None, если его нет / он несовместим."""
+    if not os.path.exists(SNAPSHOT_PATH):
+        return None
+    try:
+        with gzip.open(SNAPSHOT_PATH, "rt", encoding="utf-8") as f:
+            payload = json.load(f)
+    except Exception as e:
+        logger.error(f"Snapshot load error: {e}")
+        return None
+
+    if payload.get("version") != SNAPSHOT_VERSION or not payload.get("catalog"):
+        logger.warning("Snapshot: формат устарел или каталог пуст — игнорируем")
+        return None
+    return payload
@@ -0,0 +1,85 @@
+# services/chat_coalescer.py
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class ChatCoalescer:
+    """
+    Склеивает очередь коротких сообщений одного чата в один запрос к AI.
+    Каждое новое сообщение отменяет ещё не ответивший запрос этого чата —
+    его текст не теряется, а уходит в следующий, объединённый запрос.
+    В каждый момент у чата максимум одна задача, поэтому история диалога
+    читается и пишется без гонок. Как только ответ получен (settle), запрос
+    больше не отменяется: его текст уже отвечен, остаётся доставить и записать.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._pending: Dict[int, List[str]] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._taken: Dict[asyncio.Task, int] = {}   # сколько сообщений из очереди чата взяла задача
+        self._settled: Set[asyncio.Task] = set()     # ответ получен — не отменяем
+
+    def submit(self, chat_id: int, text: str, run: Callable[[str], Awaitable[None]]):
+        """Добавляет сообщение; run(объединённый_текст) вызовется после паузы в window секунд."""
+        self._pending.setdefault(chat_id, []).append(text)
+        previous = self._tasks.get(chat_id)
+        if previous is not None and not previous.done() and previous not in self._settled:
+            previous.cancel()
+        self._tasks[chat_id] = asyncio.create_task(self._run(chat_id, previous, run))
+
+    def cancel(self, chat_id: int):
+        """Отменяет запрос чата и забывает неотвеченные сообщения (кнопка «Назад»)."""
+        self._pending.pop(chat_id, None)
+        task = self._tasks.pop(chat_id, None)
+        if task is not None and not task.done() and task not in self._settled:
+            task.cancel()
+
+    def settle(self, chat_id: int):
+        """
+        Вызывается из run, когда ответ модели получен: учтённые сообщения уходят из
+        очереди, а доставка ответа и запись в историю уже не прерываются новым сообщением.
+        """
+        task = asyncio.current_task()
+        taken = self._taken.pop(task, None)
+        if taken is None:
+            return
+        self._settled.add(task)
+        self._drop(chat_id, taken)
+
+    def _drop(self, chat_id: int, count: int):
+        pending = self._pending.get(chat_id, [])
+        del pending[:count]
+        if not pending:
+            self._pending.pop(chat_id, None)
+
+    async def _run(self, chat_id: int, previous: Optional[asyncio.Task], run: Callable[[str], Awaitable[None]]):
+        # Ждём, пока отменённый запрос действительно остановится — он мог писать в историю
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        await asyncio.sleep(self.window)
+
+        texts = list(self._pending.get(chat_id, []))
+        if not texts:
+            return
+        task = asyncio.current_task()
+        self._taken[task] = len(texts)
+        try:
+            await run("\n".join(texts))
+        except asyncio.CancelledError:
+            self._taken.pop(task, None)   # текст не отвечен — уйдёт в следующий запрос
+            raise
+        except Exception as e:
+            logger.exception(f"AI request for chat {chat_id} failed: {e}")
+        finally:
+            self._settled.discard(task)
+            if self._tasks.get(chat_id) is task:
+                del self._tasks[chat_id]
+
+        # Запрос завершён без settle (ошибка) — убираем учтённые сообщения, новые остаются
+        taken = self._taken.pop(task, None)
+        if taken is not None:
+            self._drop(chat_id, taken)
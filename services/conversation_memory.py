@@ -0,0 +1,158 @@
+# services/conversation_memory.py
+import os
+import re
+from typing import Dict, List
+
+from services.catalog_retrieval import FAMILY_SYNONYMS, extract_budget, recommended_ids
+
+# ── Константы ────────────────────────────────────────────────────────────────
+HISTORY_TOKEN_BUDGET = int(os.getenv("AI_HISTORY_TOKENS", "1500"))  # бюджет истории в промпте, токенов
+MESSAGE_TOKEN_CAP    = int(os.getenv("AI_MESSAGE_TOKENS", "400"))   # старое сообщение длиннее — обрезаем
+CHARS_PER_TOKEN      = 3.0   # грубая оценка для русского текста у Claude — с запасом
+MESSAGE_OVERHEAD     = 4     # служебные токены на каждое сообщение
+SUMMARY_RESERVE      = 120   # место под сводку фактов
+MAX_SUMMARY_IDS      = 10    # сколько прошлых рекомендаций помнить в сводке
+SUMMARY_PREFIX       = "📝 Кратко о разговоре выше (для контекста):"
+
+# Для кого берут устройство — как это говорят клиенты. Начала слов (регулярки):
+# «для жены» и «жене», «для мамы» и «маме» — и родительный, и дательный падеж
+RECIPIENTS = {
+    "себе":         [r"себе", r"для себя"],
+    "ребёнку":      [r"ребенк", r"ребёнк", r"сын(?:а|у|ом)?\b", r"доч(?:к|ер|ь)", r"школьник"],
+    "жене/девушке": [r"жен(?:а|е|ы|у|ой)\b", r"девушк"],
+    "мужу/парню":   [r"муж(?:а|у|ем)?\b", r"парн(?:я|ю|ем)\b", r"парень"],
+    "родителям":    [r"мам(?:а|е|ы|у|ой|очк)", r"пап(?:а|е|ы|у|ой)\b", r"родител", r"бабушк", r"дедушк"],
+    "в подарок":    [r"подар"],
+    "для работы":   [r"для работы", r"по работе"],
+    "для учёбы":    [r"учеб", r"учёб", r"универ"],
+}
+_RECIPIENT_RES = {who: re.compile(r"\b(?:" + "|".join(keys) + ")") for who, keys in RECIPIENTS.items()}
+
+_DEVICE_RE = re.compile(
+    r"(?:сейчас|у меня|пользуюсь|был|была|стоит|хожу с|перехожу с|меняю)\s+(?:\w+\s+){0,2}?"
+    r"((?:iphone|айфон\w*|ipad|айпад\w*|macbook|макбук\w*|samsung|самсунг\w*|android|андроид\w*|xiaomi|сяоми)"
+    r"(?:\s+(?:\d{1,2}|pro|про|max|макс|mini|мини|plus|плюс|se|air))*)"
+)
+_SUMMARY_LINE_RE = re.compile(r"^• (.+?): (.+)$")
+
+# Поля сводки в порядке вывода
+F_BUDGET, F_FOR, F_DEVICE, F_INTEREST, F_RECOMMENDED = (
+    "Бюджет", "Для кого", "Сейчас пользуется", "Интересовался", "Уже рекомендовано (ID)"
+)
+FIELDS = (F_BUDGET, F_FOR, F_DEVICE, F_INTEREST, F_RECOMMENDED)
+
+
+def estimate_tokens(text: str) -> int:
+    """Локальная оценка размера текста в токенах — без токенизатора и сетевых вызовов."""
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def message_tokens(message: Dict[str, str]) -> int:
+    return estimate_tokens(str(message.get("content", ""))) + MESSAGE_OVERHEAD
+
+
+def is_summary(message: Dict[str, str]) -> bool:
+    return str(message.get("content", "")).startswith(SUMMARY_PREFIX)
+
+
+def _parse_summary(message: Dict[str, str]) -> Dict[str, str]:
+    facts = {}
+    for line in str(message.get("content", "")).splitlines():
+        m = _SUMMARY_LINE_RE.match(line)
+        if m and m.group(1) in FIELDS:
+            facts[m.group(1)] = m.group(2)
+    return facts
+
+
+def _merge_list(old: str, new: List[str]) -> str:
+    items = [i for i in old.split(", ") if i] if old else []
+    for value in new:
+        if value not in items:
+            items.append(value)
+    return ", ".join(items)
+
+
+def extract_facts(messages: List[Dict[str, str]], facts: Dict[str, str]) -> Dict[str, str]:
+    """Дополняет сводку фактами из сообщений: более поздние упоминания важнее ранних."""
+    facts = dict(facts)
+    for msg in messages:
+        if msg.get("role") != "user":
+            continue
+        text = str(msg.get("content", ""))
+        low = text.lower()
+
+        budget = extract_budget(text)
+        if budget:
+            facts[F_BUDGET] = f"до {budget:,} ₽".replace(",", " ")
+
+        recipients = [who for who, pattern in _RECIPIENT_RES.items() if pattern.search(low)]
+        if recipients:
+            facts[F_FOR] = _merge_list(facts.get(F_FOR, ""), recipients)
+
+        device = _DEVICE_RE.search(low)
+        if device:
+            facts[F_DEVICE] = device.group(1)
+
+        words = set(re.findall(r"[a-zа-яё0-9]+", low))
+        families = [f for f, syns in FAMILY_SYNONYMS.items()
+                    if f in ("iphone", "ipad", "macbook", "imac", "watch", "airpods") and words & set(syns)]
+        if families:
+            facts[F_INTEREST] = _merge_list(facts.get(F_INTEREST, ""), families)
+
+    ids = recommended_ids(messages)
+    if ids:
+        merged = _merge_list(facts.get(F_RECOMMENDED, ""), ids).split(", ")
+        facts[F_RECOMMENDED] = ", ".join(merged[-MAX_SUMMARY_IDS:])
+    return facts
+
+
+def render_summary(facts: Dict[str, str]) -> Dict[str, str]:
+    lines = [SUMMARY_PREFIX] + [f"• {field}: {facts[field]}" for field in FIELDS if facts.get(field)]
+    return {"role": "assistant", "content": "\n".join(lines)}
+
+
+def _clip(message: Dict[str, str]) -> Dict[str, str]:
+    content = str(message.get("content", ""))
+    limit = int(MESSAGE_TOKEN_CAP * CHARS_PER_TOKEN)
+    if len(content) <= limit:
+        return message
+    return {**message, "content": content[:limit].rstrip() + "…"}
+
+
+def compact_history(
+    history: List[Dict[str, str]],
+    budget: int = HISTORY_TOKEN_BUDGET,
+    max_messages: int = 20,
+) -> List[Dict[str, str]]:
+    """
+    История под бюджет токенов: последние ходы дословно (длинные старые сообщения
+    обрезаются), всё, что раньше, — одной сводкой фактов (бюджет, для кого,
+    текущее устройство, что уже рекомендовали). Сводка переживает повторные
+    сжатия — факты копятся, а не теряются вместе со старыми сообщениями.
+    """
+    messages = list(history)
+    facts: Dict[str, str] = {}
+    if messages and is_summary(messages[0]):
+        facts = _parse_summary(messages.pop(0))
+
+    # Новые сообщения из конца, пока влезают; последнее — всегда (обрезанным)
+    kept: List[Dict[str, str]] = []
+    used = SUMMARY_RESERVE
+    for msg in reversed(messages):
+        msg = _clip(msg)
+        cost = message_tokens(msg)
+        if kept and (used + cost > budget or len(kept) >= max_messages):
+            break
+        kept.append(msg)
+        used += cost
+    kept.reverse()
+
+    cut = len(messages) - len(kept)
+    if cut:
+        # Сохранённая часть должна начинаться с вопроса клиента — роли чередуются после сводки
+        while kept and kept[0].get("role") != "user":
+            kept.pop(0)
+            cut += 1
+        facts = extract_facts(messages[:cut], facts)
+
+    return [render_summary(facts)] + kept if facts else kept
@@ -1,4 +1,9 @@
 # services/data_store.py
+from services.catalog_index import CatalogIndex
+
 CATALOG = []
 SETTINGS = {}
 STAGES = ["model_group", "size", "memory", "memory_ram", "color", "sim"]
+CATEGORIES = ["iPhone", "iPad", "Mac", "Watch", "AirPods"]   # категории главного меню (keyboards.get_main_menu)
+GENERATION = 0   # номер поколения каталога, растёт при каждой подмене (см. catalog_refresher)
+INDEX = CatalogIndex(CATALOG, STAGES)   # фасетный индекс текущего поколения
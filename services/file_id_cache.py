@@ -0,0 +1,112 @@
+# services/file_id_cache.py
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+import services.data_store as store
+from services.catalog_refresher import refresher
+
+logger = logging.getLogger(__name__)
+
+# ── Константы ────────────────────────────────────────────────────────────────
+FILE_ID_CACHE_PATH = os.getenv("FILE_ID_CACHE_PATH", "media_cache.sqlite3")
+
+
+def live_image_urls() -> Set[str]:
+    """Все ссылки на картинки текущего поколения: фото товаров и заглушки из Settings."""
+    urls = {str(item.get("image", "")).strip() for item in store.CATALOG}
+    urls.update(str(v).strip() for v in store.SETTINGS.values())
+    return {u for u in urls if u.startswith("http")}
+
+
+class FileIdCache:
+    """
+    Ссылка на картинку → file_id, который Telegram вернул при первой отправке.
+    Повторная карточка уходит по file_id: Telegram не качает картинку заново,
+    а мы не перезаливаем байты. Ключ — сама ссылка, поэтому новая ссылка в
+    каталоге — это просто промах; записи для ссылок, пропавших из каталога,
+    вычищаются при смене поколения. Хранится в SQLite — переживает перезапуск
+    и общий для воркеров.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._ids: Dict[str, str] = {}
+        self._loaded = False
+        self._pruning: Optional[asyncio.Task] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        conn.execute("CREATE TABLE IF NOT EXISTS file_ids (url TEXT PRIMARY KEY, file_id TEXT NOT NULL, updated REAL)")
+        return conn
+
+    def _read_all(self) -> Dict[str, str]:
+        try:
+            with closing(self._connect()) as conn:
+                return dict(conn.execute("SELECT url, file_id FROM file_ids"))
+        except sqlite3.Error as e:
+            logger.error(f"File-id cache load error: {e}")
+            return {}
+
+    async def load(self):
+        """Читает таблицу в память (в потоке) — вызывается при старте процесса."""
+        ids = await asyncio.to_thread(self._read_all)
+        # То, что успели записать до окончания загрузки, свежее того, что лежало в файле
+        self._ids = {**ids, **self._ids}
+        self._loaded = True
+        logger.info(f"File-id cache: загружено {len(ids)} картинок")
+
+    def _execute(self, sql: str, rows: Iterable[Tuple]):
+        try:
+            with closing(self._connect()) as conn:
+                conn.executemany(sql, rows)
+        except sqlite3.Error as e:
+            logger.error(f"File-id cache write error: {e}")
+
+    def get(self, url: str) -> Optional[str]:
+        """file_id по ссылке; до load() — только то, что отправили в этом процессе."""
+        return self._ids.get(url)
+
+    async def put(self, url: str, file_id: str):
+        if self._ids.get(url) == file_id:
+            return
+        self._ids[url] = file_id
+        await asyncio.to_thread(
+            self._execute, "INSERT OR REPLACE INTO file_ids (url, file_id, updated) VALUES (?, ?, ?)",
+            [(url, file_id, time.time())],
+        )
+
+    async def forget(self, url: str):
+        """file_id перестал работать (чужой бот / удалён) — в следующий раз шлём ссылку."""
+        if self._ids.pop(url, None) is not None:
+            await asyncio.to_thread(self._execute, "DELETE FROM file_ids WHERE url = ?", [(url,)])
+
+    def prune(self):
+        """Слушатель refresher: забываем картинки, которых больше нет в каталоге и Settings."""
+        if not self._loaded or not store.CATALOG:
+            return
+        live = live_image_urls()
+        stale = [url for url in self._ids if url not in live]
+        if not stale:
+            return
+        for url in stale:
+            del self._ids[url]
+        logger.info(f"File-id cache: удалено {len(stale)} устаревших картинок")
+        # Слушатель вызывается внутри подмены поколения — диск трогаем в потоке, не в event loop
+        rows = [(url,) for url in stale]
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._execute("DELETE FROM file_ids WHERE url = ?", rows)
+            return
+        self._pruning = loop.create_task(
+            asyncio.to_thread(self._execute, "DELETE FROM file_ids WHERE url = ?", rows)
+        )
+
+
+file_ids = FileIdCache(FILE_ID_CACHE_PATH)
+refresher.add_listener(file_ids.prune)
@@ -0,0 +1,186 @@
+# services/fsm_storage.py
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+try:
+    import msgpack   # необязательная зависимость: компактнее и быстрее JSON
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# ── Константы ────────────────────────────────────────────────────────────────
+FSM_STORAGE     = os.getenv("FSM_STORAGE", "sqlite")              # sqlite | redis | memory
+FSM_SQLITE_PATH = os.getenv("FSM_SQLITE_PATH", "fsm_state.sqlite3")
+FSM_REDIS_URL   = os.getenv("FSM_REDIS_URL", "redis://localhost:6379/0")
+FSM_STATE_TTL   = int(os.getenv("FSM_STATE_TTL", str(14 * 24 * 3600)))  # секунд: забытый диалог живёт 2 недели
+FSM_DATA_TTL    = int(os.getenv("FSM_DATA_TTL", str(14 * 24 * 3600)))
+COMPRESS_FROM   = 256      # байт: меньше — сжатие не окупается
+PURGE_EVERY     = 1000     # записей между чистками просроченных ключей
+
+# Первый байт блоба — формат: какой сериализатор и сжато ли
+_F_JSON, _F_MSGPACK, _F_ZLIB = 0x01, 0x02, 0x80
+
+
+# ── Сериализация ─────────────────────────────────────────────────────────────
+def pack(data: Mapping[str, Any]) -> bytes:
+    """Данные FSM → компактный блоб: msgpack (или плотный JSON) + zlib для больших."""
+    if msgpack is not None:
+        fmt, raw = _F_MSGPACK, msgpack.packb(dict(data), use_bin_type=True)
+    else:
+        fmt, raw = _F_JSON, json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(raw) >= COMPRESS_FROM:
+        packed = zlib.compress(raw, 6)
+        if len(packed) < len(raw):
+            fmt, raw = fmt | _F_ZLIB, packed
+    return bytes([fmt]) + raw
+
+
+def unpack(blob: Optional[bytes]) -> Dict[str, Any]:
+    if not blob:
+        return {}
+    fmt, raw = blob[0], blob[1:]
+    if fmt & _F_ZLIB:
+        raw = zlib.decompress(raw)
+    if fmt & _F_MSGPACK:
+        if msgpack is None:
+            raise RuntimeError("FSM data was written with msgpack, but msgpack is not installed")
+        return msgpack.unpackb(raw, raw=False)
+    return json.loads(raw.decode("utf-8"))
+
+
+def _state_name(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+# ── SQLite ───────────────────────────────────────────────────────────────────
+class SQLiteStorage(BaseStorage):
+    """
+    FSM в локальном SQLite-файле: состояние и данные переживают перезапуск бота.
+    У каждого ключа свой срок жизни (state_ttl / data_ttl), продлевается при записи;
+    просроченное читается как пустое и периодически вычищается.
+    Запросы идут в одном отдельном потоке — event loop не ждёт диска.
+    """
+
+    def __init__(self, path: str, state_ttl: Optional[int] = None, data_ttl: Optional[int] = None):
+        self.path = path
+        self.state_ttl = state_ttl
+        self.data_ttl = data_ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-sqlite")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._writes = 0
+        self._closed = False
+
+    # Всё, что ниже до async-методов, выполняется только в потоке self._executor
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS fsm ("
+                " key TEXT PRIMARY KEY,"
+                " state TEXT, state_expires REAL,"
+                " data BLOB, data_expires REAL)"
+            )
+            conn.execute("DELETE FROM fsm WHERE COALESCE(state_expires, 1e18) < ?1 AND COALESCE(data_expires, 1e18) < ?1",
+                         (time.time(),))
+            self._conn = conn
+        return self._conn
+
+    def _expires(self, ttl: Optional[int]) -> Optional[float]:
+        return time.time() + ttl if ttl else None
+
+    def _write(self, key: str, column: str, value: Any, ttl: Optional[int]):
+        db = self._db()
+        db.execute(
+            f"INSERT INTO fsm (key, {column}, {column}_expires) VALUES (?, ?, ?) "
+            f"ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}, {column}_expires = excluded.{column}_expires",
+            (key, value, self._expires(ttl)),
+        )
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            now = time.time()
+            db.execute("UPDATE fsm SET state = NULL WHERE state_expires < ?", (now,))
+            db.execute("UPDATE fsm SET data = NULL WHERE data_expires < ?", (now,))
+            db.execute("DELETE FROM fsm WHERE state IS NULL AND data IS NULL")
+
+    def _read(self, key: str, column: str) -> Any:
+        row = self._db().execute(f"SELECT {column}, {column}_expires FROM fsm WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return row[0]
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # ── BaseStorage ──────────────────────────────────────────────────────────
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._call(self._write, self.key_builder.build(key), "state", _state_name(state), self.state_ttl)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self._call(self._read, self.key_builder.build(key), "state")
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise ValueError(f"Data must be a dict, got {type(data).__name__}")
+        blob = pack(data) if data else None
+        await self._call(self._write, self.key_builder.build(key), "data", blob, self.data_ttl)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return unpack(await self._call(self._read, self.key_builder.build(key), "data"))
+
+    async def close(self) -> None:
+        # Dispatcher сам закрывает хранилище при остановке polling/webhook — повторный вызов не ошибка
+        if self._closed:
+            return
+        self._closed = True
+
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        await self._call(_close)
+        self._executor.shutdown(wait=True)
+
+
+# ── Выбор хранилища ──────────────────────────────────────────────────────────
+def build_storage() -> BaseStorage:
+    """
+    Хранилище FSM по FSM_STORAGE. redis — общее для нескольких инстансов бота
+    (нужен пакет redis); sqlite — по умолчанию, на одной машине; memory — как раньше.
+    """
+    if FSM_STORAGE == "redis":
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError:
+            logger.error("FSM_STORAGE=redis, но пакет redis не установлен — используем SQLite")
+        else:
+            logger.info(f"FSM: Redis {FSM_REDIS_URL}")
+            return RedisStorage.from_url(
+                FSM_REDIS_URL,
+                key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True),
+                state_ttl=FSM_STATE_TTL,
+                data_ttl=FSM_DATA_TTL,
+                # RedisStorage хранит текст — плотный JSON без пробелов и \u-экранирования
+                json_dumps=lambda data: json.dumps(data, ensure_ascii=False, separators=(",", ":")),
+            )
+
+    if FSM_STORAGE == "memory":
+        logger.warning("FSM: память процесса — состояние пропадёт при перезапуске")
+        return MemoryStorage()
+
+    logger.info(f"FSM: SQLite {FSM_SQLITE_PATH} ({'msgpack' if msgpack else 'json'})")
+    return SQLiteStorage(FSM_SQLITE_PATH, state_ttl=FSM_STATE_TTL, data_ttl=FSM_DATA_TTL)
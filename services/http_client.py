@@ -0,0 +1,54 @@
+# services/http_client.py
+import logging
+import os
+from typing import Dict
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# ── Константы ────────────────────────────────────────────────────────────────
+POOL_LIMIT          = int(os.getenv("HTTP_POOL_LIMIT", "100"))          # соединений на сессию всего
+POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))  # соединений на один хост
+KEEPALIVE_TIMEOUT   = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))  # секунд держим idle-соединение
+DNS_CACHE_TTL       = 300
+
+# Сессии по назначению: у картинок свои хосты и свои лимиты, API не должны их ждать
+SESSION_LIMITS = {
+    "api":   {"limit_per_host": POOL_LIMIT_PER_HOST},
+    "media": {"limit_per_host": int(os.getenv("HTTP_MEDIA_LIMIT_PER_HOST", "8"))},
+}
+
+_sessions: Dict[str, aiohttp.ClientSession] = {}
+
+
+def get_session(name: str = "api") -> aiohttp.ClientSession:
+    """
+    Общая сессия приложения с пулом keep-alive соединений.
+    Не закрывать после запроса — жизненным циклом управляют open_sessions/close_sessions.
+    """
+    session = _sessions.get(name)
+    if session is None or session.closed:
+        limits = SESSION_LIMITS.get(name, SESSION_LIMITS["api"])
+        connector = aiohttp.TCPConnector(
+            limit=POOL_LIMIT,
+            limit_per_host=limits["limit_per_host"],
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=DNS_CACHE_TTL,
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        _sessions[name] = session
+    return session
+
+
+async def open_sessions():
+    for name in SESSION_LIMITS:
+        get_session(name)
+    logger.info(f"HTTP: открыты сессии {', '.join(_sessions)}")
+
+
+async def close_sessions():
+    for session in _sessions.values():
+        if not session.closed:
+            await session.close()
+    _sessions.clear()
@@ -0,0 +1,232 @@
+# services/image_cache.py
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set
+
+import services.data_store as store
+from services.catalog_refresher import refresher
+
+logger = logging.getLogger(__name__)
+
+# ── Константы ────────────────────────────────────────────────────────────────
+IMAGE_CACHE_DIR      = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_CACHE_MAX_MB   = int(os.getenv("IMAGE_CACHE_MAX_MB", "300"))
+PREFETCH_CONCURRENCY = int(os.getenv("IMAGE_PREFETCH_CONCURRENCY", "4"))   # параллельных скачиваний прогрева
+RESCAN_INTERVAL      = float(os.getenv("IMAGE_CACHE_RESCAN", "300"))         # секунд между пересчётами каталога с диска
+
+Downloader = Callable[[str], Awaitable[Optional[bytes]]]
+
+
+def prefetch_urls() -> Set[str]:
+    """Что прогреваем после загрузки каталога: фото товаров и заглушки *_STUB из Settings."""
+    urls = {str(item.get("image", "")).strip() for item in store.CATALOG}
+    urls.update(str(v).strip() for k, v in store.SETTINGS.items() if "stub" in str(k).lower())
+    return {u for u in urls if u.startswith("http")}
+
+
+class ImageCache:
+    """
+    Картинки на диске, адресованные хешем содержимого:
+      blobs/<sha256>      — байты (одинаковые картинки по разным ссылкам хранятся один раз)
+      urls/<sha1(ссылки)> — какой blob лежит за ссылкой
+    Общий размер ограничен, вытесняются давно не использованные (LRU по mtime).
+    Каталог делят ведущий процесс и воркеры, поэтому размер и LRU периодически
+    пересчитываются с диска — лимит общий на всех, превышение возможно лишь между
+    пересчётами. Ссылки на вытесненные и пропавшие blob удаляются вместе с ними.
+    Одновременные запросы одной ссылки склеиваются в одно скачивание.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.blob_dir = os.path.join(root, "blobs")
+        self.url_dir = os.path.join(root, "urls")
+        self.max_bytes = max_bytes
+        self._lru: "OrderedDict[str, int]" = OrderedDict()   # digest → размер, старые первыми
+        self._total = 0
+        self._pointers: Dict[str, Set[str]] = {}   # digest → файлы urls/, которые на него ссылаются
+        self._scanned = False
+        self._scanned_at = 0.0
+        self._lock = threading.Lock()   # LRU меняется из потоков to_thread
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._warmer: Optional[asyncio.Task] = None
+
+    # ── Диск (вызывается в потоке) ───────────────────────────────────────────
+    def _scan(self):
+        """Полный пересчёт с диска: blob всех процессов и ссылки на них."""
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.url_dir, exist_ok=True)
+        self._lru.clear()
+        self._total = 0
+        self._pointers = {}
+        entries = []
+        for name in os.listdir(self.blob_dir):
+            if name.endswith(".tmp"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.blob_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._lru[name] = size
+            self._total += size
+
+        dangling = 0
+        for name in os.listdir(self.url_dir):
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.url_dir, name)
+            try:
+                with open(path, encoding="ascii") as f:
+                    digest = f.read().strip()
+                if digest in self._lru:
+                    self._pointers.setdefault(digest, set()).add(name)
+                    continue
+                os.remove(path)   # blob вытеснен (возможно, другим процессом)
+                dangling += 1
+            except (OSError, UnicodeDecodeError):
+                continue
+
+        self._scanned = True
+        self._scanned_at = time.monotonic()
+        if dangling:
+            logger.info(f"Image cache: удалено {dangling} ссылок на вытесненные картинки")
+        logger.info(f"Image cache: {len(self._lru)} картинок, {self._total / 2**20:.1f} MB")
+
+    def _url_path(self, url: str) -> str:
+        return os.path.join(self.url_dir, hashlib.sha1(url.encode("utf-8")).hexdigest())
+
+    def _read(self, url: str) -> Optional[bytes]:
+        with self._lock:
+            if not self._scanned:
+                self._scan()
+        try:
+            with open(self._url_path(url), encoding="ascii") as f:
+                digest = f.read().strip()
+            path = os.path.join(self.blob_dir, digest)
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)   # для LRU после перезапуска
+        except OSError:
+            return None
+        with self._lock:
+            if digest in self._lru:
+                self._lru.move_to_end(digest)
+        return data
+
+    def _has(self, url: str) -> bool:
+        """Есть ли картинка на диске — без чтения самого blob."""
+        try:
+            with open(self._url_path(url), encoding="ascii") as f:
+                digest = f.read().strip()
+        except OSError:
+            return False
+        return bool(digest) and os.path.exists(os.path.join(self.blob_dir, digest))
+
+    @staticmethod
+    def _atomic_write(path: str, data: bytes):
+        # Уникальный временный файл рядом с целевым: кеш делят несколько процессов
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _write(self, url: str, data: bytes):
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.blob_dir, digest)
+        url_path = self._url_path(url)
+        with self._lock:
+            if not self._scanned or time.monotonic() - self._scanned_at > RESCAN_INTERVAL:
+                self._scan()
+            if digest not in self._lru:
+                self._atomic_write(path, data)
+                self._lru[digest] = len(data)
+                self._total += len(data)
+            self._lru.move_to_end(digest)
+            self._atomic_write(url_path, digest.encode("ascii"))
+            self._pointers.setdefault(digest, set()).add(os.path.basename(url_path))
+            self._evict()
+
+    def _evict(self):
+        while self._total > self.max_bytes and len(self._lru) > 1:
+            digest, size = self._lru.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(os.path.join(self.blob_dir, digest))
+            except OSError:
+                pass
+            # Ссылки на вытесненный blob — тоже, если за это время их не перезаписали на другой
+            for name in self._pointers.pop(digest, ()):
+                path = os.path.join(self.url_dir, name)
+                try:
+                    with open(path, encoding="ascii") as f:
+                        if f.read().strip() != digest:
+                            continue
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    # ── API ──────────────────────────────────────────────────────────────────
+    async def get(self, url: str, download: Downloader) -> Optional[bytes]:
+        """Байты картинки: с диска или одним скачиванием на всех одновременно спросивших."""
+        data = await asyncio.to_thread(self._read, url)
+        if data is not None:
+            return data
+
+        task = self._inflight.get(url)
+        if task is None:
+            task = asyncio.create_task(self._fetch(url, download))
+            self._inflight[url] = task
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, url: str, download: Downloader) -> Optional[bytes]:
+        data = await download(url)
+        if data:
+            try:
+                await asyncio.to_thread(self._write, url, data)
+            except OSError as e:
+                logger.warning(f"Image cache write error: {e}")
+        return data
+
+    async def prefetch(self, urls: Iterable[str], download: Downloader):
+        semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+
+        async def _one(url: str):
+            async with semaphore:
+                if url in self._inflight or not await asyncio.to_thread(self._has, url):
+                    await self.get(url, download)
+
+        urls = list(urls)
+        await asyncio.gather(*(_one(u) for u in urls), return_exceptions=True)
+        logger.info(f"Image cache: прогрев {len(urls)} ссылок завершён")
+
+    def warm_on_refresh(self, download: Downloader):
+        """
+        Регистрирует прогрев: после каждой подмены поколения в фоне качаем всё, чего нет на диске.
+        Вызывать в одном процессе (ведущем) — воркеры читают тот же каталог на диске.
+        """
+        def _listener():
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            if self._warmer is not None and not self._warmer.done():
+                self._warmer.cancel()   # прогреваем только актуальное поколение
+            self._warmer = loop.create_task(self.prefetch(prefetch_urls(), download))
+        refresher.add_listener(_listener)
+
+
+image_cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_MB * 2**20)
@@ -0,0 +1,109 @@
+# services/image_pipeline.py
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+try:
+    from PIL import Image
+except ImportError:   # Pillow в requirements; без него картинки уходят как есть (с предупреждением)
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# ── Константы ────────────────────────────────────────────────────────────────
+IMAGE_MAX_SIDE     = int(os.getenv("IMAGE_MAX_SIDE", "1280"))      # Telegram всё равно ужимает фото до 1280
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_WORKERS      = int(os.getenv("IMAGE_WORKERS", str(min(2, os.cpu_count() or 1))))
+SMALL_ENOUGH       = 300 * 1024   # JPEG меньше этого и в пределах IMAGE_MAX_SIDE не трогаем
+
+CAN_RESIZE         = Image is not None   # без Pillow уменьшать можем только выбором готового размера у Telegram
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_unavailable = False   # пул процессов не запустился — ужимаем в потоке
+_warned_no_pillow = False
+
+
+def normalize_image(data: bytes, max_side: int = IMAGE_MAX_SIDE) -> bytes:
+    """
+    Выполняется в процессе пула: уменьшает до max_side по большей стороне
+    и пережимает в JPEG (прозрачность — на белом фоне, как карточки на сайте Apple).
+    Если результат не меньше исходника или картинка не читается — возвращает исходник.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            if img.format == "JPEG" and len(data) <= SMALL_ENOUGH and max(img.size) <= max_side:
+                return data
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+            if img.mode in ("RGBA", "LA", "P"):
+                img = img.convert("RGBA")
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel("A"))
+                img = background
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+            out = io.BytesIO()
+            img.save(out, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=True)
+    except Exception:
+        return data
+    result = out.getvalue()
+    return result if len(result) < len(data) else data
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn: форк процесса с event loop и потоками небезопасен
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+async def normalize(data: bytes, max_side: int = IMAGE_MAX_SIDE) -> bytes:
+    """
+    Готовит картинку к загрузке, не занимая event loop (CPU-работа — в пуле процессов).
+    Если пул процессов недоступен (например, внутри daemon-процесса), ужимаем в потоке.
+    """
+    global _pool_unavailable, _warned_no_pillow
+    if not data:
+        return data
+    if Image is None:
+        if not _warned_no_pillow:
+            _warned_no_pillow = True
+            logger.warning("Image pipeline: Pillow не установлен — картинки уходят без ужатия")
+        return data
+    try:
+        if _pool_unavailable:
+            result = await asyncio.to_thread(normalize_image, data, max_side)
+        else:
+            result = await asyncio.get_running_loop().run_in_executor(_get_pool(), normalize_image, data, max_side)
+    except (AssertionError, OSError) as e:
+        # Процессы пула не стартуют (daemon-процесс не может иметь детей, лимиты ОС) — один раз в лог
+        _pool_unavailable = True
+        shutdown_pool(wait=False)
+        logger.warning(f"Image pipeline: пул процессов недоступен ({e!r}) — дальше ужимаем в потоке")
+        result = await asyncio.to_thread(normalize_image, data, max_side)
+    except BrokenProcessPool as e:
+        logger.warning(f"Image pipeline: пул процессов упал ({e}), пересоздаём")
+        shutdown_pool(wait=False)
+        return data
+    except Exception as e:
+        logger.warning(f"Image pipeline error: {e}")
+        return data
+    if len(result) < len(data):
+        logger.info(f"Image pipeline: {len(data) // 1024} KB → {len(result) // 1024} KB")
+    return result
+
+
+def shutdown_pool(wait: bool = True):
+    """
+    Останавливает пул. При выходе — с ожиданием: иначе дочерний процесс (воркер шарда)
+    зависает на выходе, дожидаясь процессов пула.
+    """
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=wait, cancel_futures=True)
+        _pool = None
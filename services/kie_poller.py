@@ -0,0 +1,170 @@
+# services/kie_poller.py
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import secrets
+import statistics
+import time
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+
+from aiohttp import web
+
+from services.http_client import get_session
+
+logger = logging.getLogger(__name__)
+
+# ── Константы ────────────────────────────────────────────────────────────────
+API_BASE_URL      = "https://api.kie.ai/api/v1"
+KIE_CALLBACK_URL  = os.getenv("KIE_CALLBACK_URL", "")            # публичный адрес, куда KIE шлёт результат
+KIE_CALLBACK_PATH = os.getenv("KIE_CALLBACK_PATH", "/kie/callback")
+JOB_TIMEOUT       = float(os.getenv("KIE_JOB_TIMEOUT", "240"))   # секунд ждём результат, как раньше (60 × 4 с)
+POLL_MIN          = 1.0     # самый частый опрос — в ожидаемый момент готовности
+POLL_MAX          = 8.0     # самый редкий — для затянувшихся задач
+POLL_BACKOFF      = 1.5
+EXPECTED_DEFAULT  = 30.0    # секунд до готовности, пока нет статистики
+EXPECTED_WINDOW   = 50      # по скольким последним задачам считаем типичное время
+POLL_CONCURRENCY  = 8       # одновременных запросов recordInfo
+
+
+class _Job:
+    __slots__ = ("future", "started", "next_check", "misses")
+
+    def __init__(self, future: asyncio.Future, started: float):
+        self.future = future
+        self.started = started
+        self.next_check = started
+        self.misses = 0
+
+
+def parse_record(info: Dict[str, Any]) -> Tuple[bool, Optional[str]]:
+    """(задача завершена?, ссылка на результат) по data из recordInfo или колбэка."""
+    state = info.get("state")
+    if state == "success":
+        result = json.loads(info.get("resultJson") or "{}")
+        return True, (result.get("resultUrls") or [None])[0]
+    if state == "fail":
+        logger.warning(f"KIE task {info.get('taskId')} failed: {info.get('failMsg')}")
+        return True, None
+    return False, None
+
+
+class KiePoller:
+    """
+    Один планировщик на все задачи магии вместо отдельного цикла со sleep(4) на каждую.
+    Держит все taskId в работе и опрашивает их с адаптивным интервалом: до типичного
+    времени готовности (медиана последних задач) — не дёргает, около него — часто,
+    дальше — с нарастающей паузой. Если включён колбэк KIE, результат приходит сразу,
+    а опрос остаётся страховкой.
+    """
+
+    def __init__(self, headers: Dict[str, str]):
+        self.headers = headers
+        self._jobs: Dict[str, _Job] = {}
+        self._durations: deque = deque(maxlen=EXPECTED_WINDOW)
+        self._wakeup = asyncio.Event()
+        self._loop_task: Optional[asyncio.Task] = None
+        self._semaphore = asyncio.Semaphore(POLL_CONCURRENCY)
+        self.callback_url: Optional[str] = None
+        # Токен в адресе колбэка — чужой POST не «завершит» задачу
+        self._callback_token = hashlib.sha256(f"kie-callback:{headers.get('Authorization', '')}".encode()).hexdigest()[:32]
+
+    # ── Ожидание результата ──────────────────────────────────────────────────
+    async def wait(self, task_id: str, timeout: float = JOB_TIMEOUT) -> Optional[str]:
+        """Ссылка на результат задачи, None — ошибка или таймаут."""
+        job = _Job(asyncio.get_running_loop().create_future(), time.monotonic())
+        job.next_check = job.started + self._first_delay()
+        self._jobs[task_id] = job
+        self._ensure_loop()
+        self._wakeup.set()
+        try:
+            return await asyncio.wait_for(asyncio.shield(job.future), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"KIE task {task_id}: нет результата за {timeout:.0f} с")
+            return None
+        finally:
+            self._jobs.pop(task_id, None)
+
+    def _expected(self) -> float:
+        return statistics.median(self._durations) if self._durations else EXPECTED_DEFAULT
+
+    def _first_delay(self) -> float:
+        return max(POLL_MIN, self._expected() * 0.7)
+
+    def _next_delay(self, job: _Job) -> float:
+        job.misses += 1
+        return min(POLL_MAX, POLL_MIN * POLL_BACKOFF ** (job.misses - 1))
+
+    def _resolve(self, task_id: str, url: Optional[str]):
+        job = self._jobs.get(task_id)
+        if job is None or job.future.done():
+            return
+        if url:
+            self._durations.append(time.monotonic() - job.started)
+        job.future.set_result(url)
+
+    # ── Цикл опроса ──────────────────────────────────────────────────────────
+    def _ensure_loop(self):
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self._jobs:
+            now = time.monotonic()
+            due = [tid for tid, job in self._jobs.items() if job.next_check <= now and not job.future.done()]
+            if due:
+                await asyncio.gather(*(self._check(tid) for tid in due), return_exceptions=True)
+                continue
+            pending = [job.next_check for job in self._jobs.values() if not job.future.done()]
+            if not pending:
+                break   # всё решено; новая задача заново запустит цикл через _ensure_loop
+            self._wakeup.clear()
+            try:
+                # Новая задача могла прийти с более ранним сроком — просыпаемся и по событию
+                await asyncio.wait_for(self._wakeup.wait(), max(0.0, min(pending) - now))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check(self, task_id: str):
+        job = self._jobs.get(task_id)
+        if job is None:
+            return
+        try:
+            async with self._semaphore, get_session().get(
+                f"{API_BASE_URL}/jobs/recordInfo", params={"taskId": task_id}, headers=self.headers
+            ) as resp:
+                data = await resp.json()
+            if data.get("code") == 200:
+                done, url = parse_record(data.get("data") or {})
+                if done:
+                    self._resolve(task_id, url)
+                    return
+        except Exception as e:
+            logger.warning(f"KIE poll error for {task_id}: {e}")
+        job.next_check = time.monotonic() + self._next_delay(job)
+
+    # ── Колбэк KIE ───────────────────────────────────────────────────────────
+    def enable_callbacks(self, app: web.Application, public_url: str = KIE_CALLBACK_URL):
+        """Подключает приём колбэков к aiohttp-приложению; задачи получат callBackUrl."""
+        if not public_url:
+            return
+        app.router.add_post(KIE_CALLBACK_PATH, self.handle_callback)
+        self.callback_url = f"{public_url.rstrip('/')}{KIE_CALLBACK_PATH}?token={self._callback_token}"
+        logger.info(f"KIE: колбэки включены на {KIE_CALLBACK_PATH}")
+
+    async def handle_callback(self, request: web.Request) -> web.Response:
+        if not secrets.compare_digest(request.query.get("token", ""), self._callback_token):
+            return web.Response(status=401)
+        try:
+            body = await request.json()
+        except Exception:
+            return web.Response(status=400)
+        info = body.get("data") or {}
+        task_id = info.get("taskId")
+        if task_id:
+            done, url = parse_record(info)
+            if done:
+                self._resolve(task_id, url)
+        return web.json_response({"code": 200})
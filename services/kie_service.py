@@ -1,29 +1,30 @@
 import aiohttp
-import asyncio
 import logging
-import json
-import base64
 import os
 
+from services.assistant_service import notify_admin
+from services.http_client import get_session
+from services.image_pipeline import CAN_RESIZE, normalize
+from services.kie_poller import API_BASE_URL, KiePoller
+
 logger = logging.getLogger(__name__)
 
 UPLOAD_BASE_URL = "https://kieai.redpandaai.co"
-API_BASE_URL    = "https://api.kie.ai/api/v1"
+MAGIC_RESOLUTION = "1K"
+MAGIC_MAX_SIDE   = int(os.getenv("MAGIC_MAX_SIDE", "1024"))   # модель работает в 1K — больше грузить незачем
+
+
+def pick_photo_size(sizes: list):
+    """
+    Какой из размеров фото Telegram скачивать. С Pillow — наименьший, которого хватает
+    модели (дальше ужмём до MAGIC_MAX_SIDE сами); без Pillow — наибольший, не превышающий
+    MAGIC_MAX_SIDE: уменьшение уже сделал Telegram.
+    """
+    if CAN_RESIZE:
+        return next((p for p in sizes if max(p.width, p.height) >= MAGIC_MAX_SIDE), sizes[-1])
+    fitting = [p for p in sizes if max(p.width, p.height) <= MAGIC_MAX_SIDE]
+    return fitting[-1] if fitting else sizes[0]
 
-# ── Уведомления Админу через @vnxSYSNOTIFY_bot ───────────────────────────────
-async def notify_admin(text: str):
-    """Экстренная отправка сообщения админу (MANAGER_ID) через бота уведомлений"""
-    token = os.getenv("NOTIFY_BOT_TOKEN")
-    admin_id = os.getenv("MANAGER_ID")
-    if not token or not admin_id:
-        logger.warning("NOTIFY_BOT_TOKEN или MANAGER_ID не заданы. Уведомление не отправлено.")
-        return
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
-    try:
-        async with aiohttp.ClientSession() as session:
-            await session.post(url, json={"chat_id": admin_id, "text": text, "parse_mode": "HTML"})
-    except Exception as e:
-        logger.error(f"Admin notification failed: {e}")
 
 def _detect_mime(photo_bytes: bytes) -> str:
     if photo_bytes[:4] == b'\x89PNG': return "image/png"
@@ -31,6 +32,8 @@ def _detect_mime(photo_bytes: bytes) -> str:
     if photo_bytes[:4] == b'RIFF' and photo_bytes[8:12] == b'WEBP': return "image/webp"
     return "image/jpeg"
 
+_EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp"}
+
 class KieService:
     def __init__(self, api_key: str):
         self.api_key = api_key
@@ -38,14 +41,18 @@ class KieService:
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        self.poller = KiePoller(self.headers)   # один планировщик опроса на все задачи
 
     async def _upload_image(self, session: aiohttp.ClientSession, photo_bytes: bytes) -> str | None:
+        # Бинарный multipart вместо base64 в JSON: на треть меньше трафика и без лишних копий в памяти
         mime = _detect_mime(photo_bytes)
-        b64 = base64.b64encode(photo_bytes).decode("utf-8")
-        data_uri = f"data:{mime};base64,{b64}"
-        payload = {"base64Data": data_uri, "uploadPath": "images/tgbot"}
+        form = aiohttp.FormData()
+        form.add_field("file", photo_bytes, filename=f"photo.{_EXTENSIONS[mime]}", content_type=mime)
+        form.add_field("uploadPath", "images/tgbot")
 
-        async with session.post(f"{UPLOAD_BASE_URL}/api/file-base64-upload", json=payload) as resp:
+        # Content-Type с boundary выставит сам aiohttp — JSON-заголовок тут не подходит
+        headers = {"Authorization": self.headers["Authorization"]}
+        async with session.post(f"{UPLOAD_BASE_URL}/api/file-stream-upload", data=form, headers=headers) as resp:
             data = await resp.json()
             return data.get("data", {}).get("downloadUrl")
 
@@ -62,10 +69,12 @@ class KieService:
                 "image_input": [image_url],
                 "aspect_ratio": "9:16",
                 "output_format": "png",
-                "resolution": "1K"
+                "resolution": MAGIC_RESOLUTION
             }
         }
-        async with session.post(f"{API_BASE_URL}/jobs/createTask", json=payload) as resp:
+        if self.poller.callback_url:
+            payload["callBackUrl"] = self.poller.callback_url
+        async with session.post(f"{API_BASE_URL}/jobs/createTask", json=payload, headers=self.headers) as resp:
             data = await resp.json()
             
             # Проверка баланса: KIE возвращает ошибку о кредитах
@@ -75,27 +84,16 @@ class KieService:
                 
             return data.get("data", {}).get("taskId") if data.get("code") == 200 else None
 
-    async def _poll_result(self, session: aiohttp.ClientSession, task_id: str) -> str | None:
-        for _ in range(60):
-            await asyncio.sleep(4)
-            async with session.get(f"{API_BASE_URL}/jobs/recordInfo", params={"taskId": task_id}) as resp:
-                res_data = await resp.json()
-                if res_data.get("code") != 200: continue
-                info = res_data.get("data", {})
-                if info.get("state") == "success":
-                    result = json.loads(info.get("resultJson", "{}"))
-                    return result.get("resultUrls", [None])[0]
-                if info.get("state") == "fail": return None
-        return None
-
     async def generate_magic_image(self, photo_bytes: bytes, product_title: str) -> str | None:
-        async with aiohttp.ClientSession(headers=self.headers) as session:
-            try:
-                url = await self._upload_image(session, photo_bytes)
-                if not url: return None
-                tid = await self._create_task(session, url, product_title)
-                if not tid: return None
-                return await self._poll_result(session, tid)
-            except Exception as e:
-                logger.exception(f"KIE Error: {e}")
-                return None
+        session = get_session()
+        try:
+            # Уменьшаем до разрешения, в котором работает модель (в пуле процессов, если есть Pillow)
+            photo_bytes = await normalize(photo_bytes, max_side=MAGIC_MAX_SIDE)
+            url = await self._upload_image(session, photo_bytes)
+            if not url: return None
+            tid = await self._create_task(session, url, product_title)
+            if not tid: return None
+            return await self.poller.wait(tid)
+        except Exception as e:
+            logger.exception(f"KIE Error: {e}")
+            return None
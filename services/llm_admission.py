@@ -0,0 +1,162 @@
+# services/llm_admission.py
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Deque, Optional
+
+logger = logging.getLogger(__name__)
+
+# ── Константы ────────────────────────────────────────────────────────────────
+AI_MAX_CONCURRENT = int(os.getenv("AI_MAX_CONCURRENT", "8"))       # одновременных запросов к LLM
+AI_RATE_PER_SEC   = float(os.getenv("AI_RATE_PER_SEC", "2"))       # новых запросов в секунду в среднем
+AI_BURST          = int(os.getenv("AI_BURST", "6"))                # сколько можно выпустить разом после затишья
+AI_MAX_QUEUE      = int(os.getenv("AI_MAX_QUEUE", "200"))          # дальше — отказ сразу, без ожидания
+AI_QUEUE_TIMEOUT  = float(os.getenv("AI_QUEUE_TIMEOUT", "90"))     # секунд ожидания в очереди максимум
+STATUS_POLL       = 1.0                                            # как часто пересчитываем место в очереди
+
+# С BOT_WORKERS > 0 у каждого процесса-воркера свой admission — делим лимиты провайдера
+# поровну, иначе вместе они выпустят в N раз больше настроенного
+_SHARDS = max(1, int(os.getenv("BOT_WORKERS", "0")))
+
+OnQueued = Callable[[int], Awaitable[None]]
+
+
+class AdmissionRejected(Exception):
+    """Очередь переполнена или ожидание затянулось — запрос к LLM не выполняем."""
+
+
+class AdmissionController:
+    """
+    Пропускной пункт перед LLM: не больше max_concurrent запросов одновременно,
+    не быстрее token bucket (rate в секунду, запас burst) и строго по очереди (FIFO) —
+    никто не обгоняет того, кто ждёт дольше. Ответ провайдера «перегружен»
+    (429/529) ставит выдачу на паузу, а не роняет всех ожидающих.
+    """
+
+    def __init__(self, max_concurrent: int, rate: float, burst: int, max_queue: int, queue_timeout: float):
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._active = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._queue: Deque[asyncio.Future] = deque()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    # ── Token bucket ─────────────────────────────────────────────────────────
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _delay_until_token(self, now: float) -> float:
+        if now < self._paused_until:
+            return self._paused_until - now
+        return max(0.0, (1.0 - self._tokens) / self.rate) if self.rate > 0 else 0.0
+
+    def _dispatch(self):
+        """Выпускает из головы очереди столько запросов, сколько позволяют слоты и токены."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        now = time.monotonic()
+        self._refill(now)
+        while self._queue and self._active < self.max_concurrent:
+            if self._queue[0].done():          # ожидающий ушёл (отмена/таймаут)
+                self._queue.popleft()
+                continue
+            if now < self._paused_until or (self.rate > 0 and self._tokens < 1.0):
+                # Слот есть, токена нет — просыпаемся ровно к следующему токену
+                delay = self._delay_until_token(now)
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            if self.rate > 0:
+                self._tokens -= 1.0
+            self._active += 1
+            self._queue.popleft().set_result(None)
+
+    def _release(self):
+        self._active -= 1
+        self._dispatch()
+
+    def pause(self, seconds: float):
+        """Провайдер просит притормозить — новых запросов не выпускаем seconds секунд."""
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            self._tokens = 0.0
+            logger.warning(f"LLM admission: пауза выдачи на {seconds:.0f}с (очередь {self.queued})")
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for f in self._queue if not f.done())
+
+    def _position(self, fut: asyncio.Future) -> int:
+        position = 0
+        for f in self._queue:
+            if not f.done():
+                position += 1
+            if f is fut:
+                return position
+        return 0
+
+    # ── Вход ─────────────────────────────────────────────────────────────────
+    @asynccontextmanager
+    async def slot(self, on_queued: Optional[OnQueued] = None) -> AsyncIterator[None]:
+        """
+        Занимает место для одного запроса к LLM на время блока.
+        Пока запрос ждёт, on_queued(место_в_очереди) вызывается при каждом изменении места.
+        Переполненная очередь или слишком долгое ожидание → AdmissionRejected.
+        """
+        if self.queued >= self.max_queue:
+            raise AdmissionRejected(f"queue is full ({self.max_queue})")
+
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.append(fut)
+        self._dispatch()
+
+        granted = False
+        try:
+            deadline = time.monotonic() + self.queue_timeout
+            reported = 0
+            while not fut.done():
+                position = self._position(fut)
+                if on_queued is not None and position != reported:
+                    reported = position
+                    try:
+                        await on_queued(position)
+                    except Exception as e:
+                        logger.warning(f"LLM admission status error: {e}")
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise AdmissionRejected(f"waited in queue longer than {self.queue_timeout:.0f}s")
+                await asyncio.wait({fut}, timeout=min(STATUS_POLL, left))
+            granted = True
+        finally:
+            if not granted:
+                if fut.done() and not fut.cancelled():
+                    self._release()       # слот выдали в момент отмены — возвращаем
+                else:
+                    fut.cancel()
+                    self._dispatch()
+
+        try:
+            yield
+        finally:
+            self._release()
+
+
+admission = AdmissionController(
+    max(1, AI_MAX_CONCURRENT // _SHARDS),
+    AI_RATE_PER_SEC / _SHARDS,
+    max(1, AI_BURST // _SHARDS),
+    max(1, AI_MAX_QUEUE // _SHARDS),
+    AI_QUEUE_TIMEOUT,
+)
@@ -0,0 +1,75 @@
+# services/response_cache.py
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import services.data_store as store
+from services.catalog_refresher import refresher
+
+logger = logging.getLogger(__name__)
+
+# ── Константы ────────────────────────────────────────────────────────────────
+FIRST_TURN_CACHE     = os.getenv("AI_FIRST_TURN_CACHE", "1") != "0"
+FIRST_TURN_CACHE_MAX = int(os.getenv("AI_FIRST_TURN_CACHE_MAX", "500"))    # вопросов в памяти
+FIRST_TURN_CACHE_TTL = float(os.getenv("AI_FIRST_TURN_CACHE_TTL", "1800"))  # секунд жизни ответа
+
+_WORD_RE = re.compile(r"[a-zа-я0-9]+")
+
+
+def normalize_question(text: str) -> str:
+    """«Какой айфон взять до 100к?!» и «какой  Айфон взять до 100к» — один ключ."""
+    return " ".join(_WORD_RE.findall(text.lower().replace("ё", "е")))
+
+
+def is_first_turn(history: List[Dict[str, str]]) -> bool:
+    """Первый вопрос диалога: в истории нет сообщений клиента (максимум приветствие)."""
+    return not any(m.get("role") == "user" for m in history)
+
+
+class FirstTurnCache:
+    """
+    Ответы AI на первый вопрос диалога — он не зависит ни от чего, кроме самого
+    вопроса и каталога. LRU с TTL; ключ включает поколение каталога, а при смене
+    поколения кеш очищается целиком — цены и наличие в ответах всегда актуальны.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[Tuple[int, str], Tuple[float, str]]" = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, question: str, generation: int) -> Optional[str]:
+        key = (generation, normalize_question(question))
+        entry = self._items.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._items[key]
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, question: str, generation: int, reply: str):
+        if generation != store.GENERATION:
+            return   # каталог сменился, пока модель отвечала — ответ уже не про текущие цены
+        key = (generation, normalize_question(question))
+        if not key[1]:
+            return
+        self._items[key] = (time.monotonic() + self.ttl, reply)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        if self._items:
+            logger.info(f"First-turn cache: сброшено {len(self._items)} ответов (hits={self.hits}, misses={self.misses})")
+        self._items.clear()
+
+
+first_turn_cache = FirstTurnCache(FIRST_TURN_CACHE_MAX, FIRST_TURN_CACHE_TTL)
+refresher.add_listener(first_turn_cache.clear)
@@ -1,13 +1,25 @@
 import os
+import asyncio
+import functools
 import logging
 import json
 import re
 import gspread
-import time
-from typing import List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
 
 logger = logging.getLogger(__name__)
 
+# ── Константы ────────────────────────────────────────────────────────────────
+SHEETS_MAX_WORKERS = int(os.getenv("SHEETS_MAX_WORKERS", "2"))   # потоков под синхронный gspread
+SHEETS_RETRIES     = 3
+SHEETS_BACKOFF     = 2.0   # секунд, удваивается с каждой попыткой
+
+# ─── Кеш инкрементальной синхронизации ──────────────────────────────────────
+# Ключи — hash() сырой строки: стабилен в пределах процесса, дешевле json/sha
+_ROW_CACHE: Dict[str, Dict[int, Dict[str, Any]]] = {}   # лист → {хеш строки → очищенная запись}
+_SHEET_DIGESTS: Dict[str, int] = {}                     # лист → хеш всего содержимого при прошлой загрузке
+
 # ─── Маппинг наборов флагов → название региона ──────────────────────────────
 # Флаги зашиты в поле "id" по стандарту Facebook Commerce
 _REGION_MAP = {
@@ -64,104 +76,181 @@ def authorize_gspread():
         return None
 
 
-def get_data_from_sheet(sheet_name: str = "vnxSHOP", retries: int = 3) -> List[Dict[str, Any]]:
-    gc = authorize_gspread()
-    if not gc:
-        return []
+class SheetsGateway:
+    """
+    Асинхронный шлюз к Google Sheets.
+    gspread синхронный, поэтому все сетевые вызовы уходят в ограниченный пул
+    потоков — event loop и чаты других пользователей не замерзают.
+    Авторизованный клиент и открытая таблица переиспользуются между вызовами.
+    """
 
-    spreadsheet_id = os.getenv("SPREADSHEET_ID")
+    def __init__(self, max_workers: int = SHEETS_MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sheets")
+        self._client: Optional[gspread.Client] = None
+        self._spreadsheet: Optional[gspread.Spreadsheet] = None
+        self._lock = asyncio.Lock()
 
-    for attempt in range(retries):
-        try:
-            spreadsheet = gc.open_by_key(spreadsheet_id)
-            worksheet   = spreadsheet.worksheet(sheet_name)
-            raw_data    = worksheet.get_all_records()
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
 
-            cleaned = []
-            for row in raw_data:
-                if not row.get("id"):
-                    continue
+    async def _open(self) -> Optional[gspread.Spreadsheet]:
+        if self._spreadsheet is not None:
+            return self._spreadsheet
+        async with self._lock:
+            if self._spreadsheet is None:
+                if self._client is None:
+                    self._client = await self._run(authorize_gspread)
+                    if self._client is None:
+                        return None
+                self._spreadsheet = await self._run(self._client.open_by_key, os.getenv("SPREADSHEET_ID"))
+        return self._spreadsheet
 
-                # ── Стандартные столбцы Facebook Commerce ─────────────────
-                raw_price = str(row.get("price", "0"))
-                price     = re.sub(r"[^\d]", "", raw_price) or "0"
-
-                model_group = str(row.get("item_group_id", "")).strip()
-                if not model_group:
-                    model_group = str(row.get("title", "")).strip()
-
-                color  = str(row.get("color", "")).strip() or "-"
-                sim    = str(row.get("sim",   "")).strip() or "-"
-                
-                # Физический размер (диагональ / mm)
-                size_val = str(row.get("size", "")).strip() or "-"
-
-                # ── Кастомные столбцы в конце таблицы ─────────────────────
-                # memory_ssd: хранилище для iPhone/iPad/Mac (256GB, 512GB, 1TB)
-                # memory_ram: ОЗУ только для Mac/iMac (16GB, 24GB, 32GB)
-                memory_ssd = str(row.get("memory_ssd", "")).strip() or "-"
-                memory_ram = str(row.get("memory_ram", "")).strip() or "-"
-
-                # custom_label_0 = регион (International / Россия / EU)
-                # Сначала пробуем колонку custom_label_0, потом старый _extract_region
-                custom_label_0 = str(row.get("custom_label_0", "")).strip()
-                if not custom_label_0 or custom_label_0 in ("0", "-", ""):
-                    custom_label_0 = _extract_region(row)
-
-                custom_label_1 = str(row.get("custom_label_1", "")).strip() or "-"
-                custom_label_2 = str(row.get("custom_label_2", "")).strip() or "-"
-
-                entry = {
-                    "id":             str(row.get("id", "")).strip(),
-                    "title":          str(row.get("title", "")).strip(),
-                    "availability":   str(row.get("availability", "out of stock")).strip(),
-                    "price":          price,
-                    "image":          str(row.get("image_link", "")).strip(),
-                    "color":          color,
-                    "size":           size_val,
-                    "memory":         memory_ssd,  # Главный ключ для воронки, берет данные из memory_ssd
-                    "memory_ssd":     memory_ssd,
-                    "memory_ram":     memory_ram,
-                    "sim":            sim,
-                    "model_group":    model_group,
-                    "region":         custom_label_0,
-                    "custom_label_0": custom_label_0,
-                    "custom_label_1": custom_label_1,
-                    "custom_label_2": custom_label_2,
-                }
-                cleaned.append(entry)
-
-            logger.info(
-                f"Sheets: загружено {len(cleaned)} строк. "
-            )
-            return cleaned
+    async def get_all_records(self, sheet_name: str, retries: int = SHEETS_RETRIES) -> Optional[List[Dict[str, Any]]]:
+        """Все строки листа или None, если Sheets недоступен после всех попыток."""
+        for attempt in range(retries):
+            try:
+                spreadsheet = await self._open()
+                if spreadsheet is None:
+                    return None
+                worksheet = await self._run(spreadsheet.worksheet, sheet_name)
+                return await self._run(worksheet.get_all_records)
+            except Exception as e:
+                # Сбрасываем таблицу — на следующей попытке откроем заново
+                self._spreadsheet = None
+                if attempt < retries - 1:
+                    delay = SHEETS_BACKOFF * (2 ** attempt)
+                    logger.warning(f"Sheets retry {attempt + 1} ({sheet_name}) через {delay:.0f}s: {e}")
+                    await asyncio.sleep(delay)
+                    continue
+                logger.error(f"Sheets error ({sheet_name}): {e}")
+        return None
 
+    async def modified_time(self) -> Optional[str]:
+        """
+        modifiedTime таблицы из Drive API — один лёгкий запрос вместо выгрузки листа.
+        None, если метаданные недоступны (старый gspread, нет прав на Drive).
+        """
+        try:
+            spreadsheet = await self._open()
+            getter = getattr(spreadsheet, "get_lastUpdateTime", None)
+            if getter is None:
+                return None
+            return await self._run(getter)
         except Exception as e:
-            if attempt < retries - 1:
-                logger.warning(f"Sheets retry {attempt + 1}: {e}")
-                time.sleep(2)
-                continue
-            logger.error(f"Sheets error: {e}")
+            logger.warning(f"Sheets modifiedTime недоступен: {e}")
+            return None
 
-    return []
+    def close(self):
+        self._executor.shutdown(wait=False)
 
 
-def get_settings():
-    gc = authorize_gspread()
-    if not gc:
-        return {}
-    try:
-        spreadsheet = gc.open_by_key(os.getenv("SPREADSHEET_ID"))
-        rows = spreadsheet.worksheet("Settings").get_all_records()
-        result = {}
-        for r in rows:
-            # Поддерживаем и английские (Key/Value), и русские заголовки
-            k = r.get("Key") or r.get("Категория")
-            v = r.get("Value") or r.get("Ссылка")
-            if k:
-                result[str(k)] = str(v)
-        logger.info(f"Settings: загружено {len(result)} ключей")
-        return result
-    except Exception as e:
-        logger.error(f"Settings error: {e}")
+sheets = SheetsGateway()
+
+
+def _clean_row(row: dict) -> Dict[str, Any]:
+    # ── Стандартные столбцы Facebook Commerce ─────────────────
+    raw_price = str(row.get("price", "0"))
+    price     = re.sub(r"[^\d]", "", raw_price) or "0"
+
+    model_group = str(row.get("item_group_id", "")).strip()
+    if not model_group:
+        model_group = str(row.get("title", "")).strip()
+
+    color  = str(row.get("color", "")).strip() or "-"
+    sim    = str(row.get("sim",   "")).strip() or "-"
+
+    # Физический размер (диагональ / mm)
+    size_val = str(row.get("size", "")).strip() or "-"
+
+    # ── Кастомные столбцы в конце таблицы ─────────────────────
+    # memory_ssd: хранилище для iPhone/iPad/Mac (256GB, 512GB, 1TB)
+    # memory_ram: ОЗУ только для Mac/iMac (16GB, 24GB, 32GB)
+    memory_ssd = str(row.get("memory_ssd", "")).strip() or "-"
+    memory_ram = str(row.get("memory_ram", "")).strip() or "-"
+
+    # custom_label_0 = регион (International / Россия / EU)
+    # Сначала пробуем колонку custom_label_0, потом старый _extract_region
+    custom_label_0 = str(row.get("custom_label_0", "")).strip()
+    if not custom_label_0 or custom_label_0 in ("0", "-", ""):
+        custom_label_0 = _extract_region(row)
+
+    custom_label_1 = str(row.get("custom_label_1", "")).strip() or "-"
+    custom_label_2 = str(row.get("custom_label_2", "")).strip() or "-"
+
+    return {
+        "id":             str(row.get("id", "")).strip(),
+        "title":          str(row.get("title", "")).strip(),
+        "availability":   str(row.get("availability", "out of stock")).strip(),
+        "price":          price,
+        "image":          str(row.get("image_link", "")).strip(),
+        "color":          color,
+        "size":           size_val,
+        "memory":         memory_ssd,  # Главный ключ для воронки, берет данные из memory_ssd
+        "memory_ssd":     memory_ssd,
+        "memory_ram":     memory_ram,
+        "sim":            sim,
+        "model_group":    model_group,
+        "region":         custom_label_0,
+        "custom_label_0": custom_label_0,
+        "custom_label_1": custom_label_1,
+        "custom_label_2": custom_label_2,
+    }
+
+
+async def get_data_from_sheet(
+    sheet_name: str = "vnxSHOP",
+    retries: int = SHEETS_RETRIES,
+    skip_unchanged: bool = False,
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    Загружает и чистит лист каталога.
+    _clean_row запускается только для строк, содержимое которых изменилось с прошлой
+    загрузки. С skip_unchanged=True возвращает None, если лист не менялся вовсе.
+    """
+    raw_data = await sheets.get_all_records(sheet_name, retries)
+    if raw_data is None:
+        return []
+
+    digests = [hash(tuple(row.items())) for row in raw_data]
+    sheet_digest = hash(tuple(digests))
+    if skip_unchanged and _SHEET_DIGESTS.get(sheet_name) == sheet_digest:
+        logger.info(f"Sheets: лист {sheet_name} не изменился")
+        return None
+
+    old_rows = _ROW_CACHE.get(sheet_name, {})
+    new_rows: Dict[int, Dict[str, Any]] = {}
+    cleaned = []
+    recleaned = 0
+    for row, digest in zip(raw_data, digests):
+        if not row.get("id"):
+            continue
+        entry = new_rows.get(digest) or old_rows.get(digest)
+        if entry is None:
+            entry = _clean_row(row)
+            recleaned += 1
+        new_rows[digest] = entry
+        cleaned.append(entry)
+
+    _ROW_CACHE[sheet_name] = new_rows
+    _SHEET_DIGESTS[sheet_name] = sheet_digest
+    logger.info(
+        f"Sheets: загружено {len(cleaned)} строк. "
+        f"Изменилось: {recleaned}"
+    )
+    return cleaned
+
+
+async def get_settings():
+    rows = await sheets.get_all_records("Settings")
+    if rows is None:
         return {}
+    result = {}
+    for r in rows:
+        # Поддерживаем и английские (Key/Value), и русские заголовки
+        k = r.get("Key") or r.get("Категория")
+        v = r.get("Value") or r.get("Ссылка")
+        if k:
+            result[str(k)] = str(v)
+    logger.info(f"Settings: загружено {len(result)} ключей")
+    return result
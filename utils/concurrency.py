@@ -0,0 +1,26 @@
+# utils/concurrency.py
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+
+class ConcurrencyMiddleware(BaseMiddleware):
+    """
+    Не больше limit апдейтов обрабатываются одновременно — и в polling, и в webhook.
+    Остальные ждут своей очереди в памяти, а не открывают сотни запросов к Sheets/AI разом.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with self._semaphore:
+            return await handler(event, data)
@@ -1,8 +1,13 @@
 # utils/media.py
 import logging
 import aiohttp
-from aiogram.types import InputMediaPhoto, BufferedInputFile
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InputMediaPhoto, BufferedInputFile, Message
 import services.data_store as store
+from services.file_id_cache import file_ids
+from services.http_client import get_session
+from services.image_cache import image_cache
+from services.image_pipeline import normalize
 
 logger = logging.getLogger(__name__)
 
@@ -60,45 +65,67 @@ def get_stub(cat, model=""):
     return ""
 
 async def fetch_image_bytes(url: str) -> bytes | None:
+    """Картинка по ссылке — из дискового кеша, иначе скачиваем (один раз на всех ждущих)."""
     if not url or not url.startswith("http"):
         return None
+    return await image_cache.get(url, _download_image)
+
+async def _download_image(url: str) -> bytes | None:
     try:
-        async with aiohttp.ClientSession(headers=FETCH_HEADERS) as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as resp:
-                if resp.status == 200:
-                    data = await resp.read()
-                    return data
-                logger.error(f"❌ Ошибка скачивания фото (Код {resp.status}) по ссылке: {url[:60]}")
-                return None
+        async with get_session("media").get(url, headers=FETCH_HEADERS, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+            if resp.status == 200:
+                data = await resp.read()
+                # В кеш (и в Telegram) идёт уже ужатая картинка
+                return await normalize(data)
+            logger.error(f"❌ Ошибка скачивания фото (Код {resp.status}) по ссылке: {url[:60]}")
+            return None
     except Exception as e:
         logger.warning(f"❌ fetch_image_bytes error: {e}")
         return None
 
+def enable_prefetch():
+    """После каждой загрузки каталога картинки товаров и заглушки качаются на диск заранее."""
+    image_cache.warm_on_refresh(_download_image)
+
 async def send_photo_safe(target, url: str, caption: str, reply_markup, is_edit: bool = False):
     if not url:
         if is_edit: await target.edit_caption(caption=caption, reply_markup=reply_markup)
         else: await target.answer(caption, reply_markup=reply_markup)
         return
 
-    async def _as_buffered(photo_bytes: bytes):
-        buf = BufferedInputFile(photo_bytes, filename="photo.jpg")
+    async def _send(media):
         if is_edit:
-            await target.edit_media(InputMediaPhoto(media=buf, caption=caption), reply_markup=reply_markup)
-        else:
-            await target.answer_photo(buf, caption=caption, reply_markup=reply_markup)
+            return await target.edit_media(InputMediaPhoto(media=media, caption=caption), reply_markup=reply_markup)
+        return await target.answer_photo(media, caption=caption, reply_markup=reply_markup)
+
+    async def _remember(sent):
+        # Telegram уже хранит эту картинку у себя — дальше шлём её по file_id
+        if isinstance(sent, Message) and sent.photo:
+            await file_ids.put(url, sent.photo[-1].file_id)
+
+    async def _as_buffered(photo_bytes: bytes):
+        return await _send(BufferedInputFile(photo_bytes, filename="photo.jpg"))
+
+    # 0. Картинку уже отправляли — Telegram не нужно ничего качать
+    file_id = file_ids.get(url)
+    if file_id:
+        try:
+            await _send(file_id)
+            return
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e): return
+            logger.warning(f"⚠️ file_id для {url[:40]} не принят ({e}), отправляем заново")
+            await file_ids.forget(url)
 
     try:
         # Сначала пробуем отправить ссылку напрямую
-        if is_edit:
-            await target.edit_media(InputMediaPhoto(media=url, caption=caption), reply_markup=reply_markup)
-        else:
-            await target.answer_photo(url, caption=caption, reply_markup=reply_markup)
+        await _remember(await _send(url))
     except Exception as e:
         logger.warning(f"⚠️ Прямая ссылка не сработала ({e}), качаю байты для {url[:40]}...")
         # Если Телеграм ругается на формат ссылки, качаем сами
         photo_bytes = await fetch_image_bytes(url)
         if photo_bytes:
-            await _as_buffered(photo_bytes)
+            await _remember(await _as_buffered(photo_bytes))
         else:
             logger.error("❌ Не удалось ни отправить ссылку, ни скачать байты. Отправляем голый текст.")
             if is_edit: